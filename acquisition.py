@@ -0,0 +1,237 @@
+import threading
+import collections
+import struct
+import logging as log
+import numpy as np
+
+
+class FrameBuffer:
+    """
+    Fixed-size, thread safe ring buffer of int8 frames.
+
+    When the buffer is full the oldest frame is overwritten, so a slow
+    consumer loses history rather than stalling the producer.
+
+    Parameters
+    ----------
+    capacity : int
+        Maximum number of frames held in the buffer.
+    frame_len : int
+        Number of samples in a frame.
+
+    Attributes
+    ----------
+    capacity : int
+        Maximum number of frames held in the buffer.
+    frame_len : int
+        Number of samples in a frame.
+    dropped : int
+        Number of frames overwritten before they were consumed.
+
+    Public Methods
+    --------------
+    put(self, frames):
+        Appends one or more frames to the buffer.
+
+    get(self):
+        Removes and returns the oldest frame in the buffer.
+
+    get_all(self):
+        Removes and returns every frame in the buffer, oldest first.
+
+    reset(self, frame_len=None):
+        Empties the buffer, optionally changing the frame length.
+    """
+
+    def __init__(self, capacity, frame_len):
+        self.capacity = capacity
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self.reset(frame_len)
+        return
+
+    def __len__(self):
+        return self._count
+
+    def reset(self, frame_len=None):
+        """Empties the buffer, optionally changing the frame length."""
+        if frame_len is not None:
+            self.frame_len = frame_len
+            self._frames = np.zeros((self.capacity, frame_len), dtype=np.int8)
+        self._head = 0  # index of the next frame to be written
+        self._count = 0
+        return
+
+    def put(self, frames):
+        """
+        Appends one or more frames to the buffer, copying the data. If the frame
+        length has changed the buffer is emptied first.
+        """
+        frames = np.atleast_2d(frames)
+        with self._lock:
+            if frames.shape[1] != self.frame_len:
+                self.reset(frames.shape[1])
+
+            for frame in frames[-self.capacity:]:
+                self._frames[self._head] = frame
+                self._head = (self._head + 1) % self.capacity
+                if self._count == self.capacity:
+                    self.dropped += 1
+                else:
+                    self._count += 1
+            self.dropped += max(len(frames) - self.capacity, 0)
+        return
+
+    def get(self):
+        """Removes and returns the oldest frame in the buffer, or None if empty."""
+        with self._lock:
+            if self._count == 0:
+                return None
+            frame = self._frames[(self._head - self._count) % self.capacity].copy()
+            self._count -= 1
+        return frame
+
+    def get_all(self):
+        """Removes and returns every frame in the buffer as a (n, frame_len) array."""
+        with self._lock:
+            index = np.arange(self._head - self._count, self._head) % self.capacity
+            frames = self._frames[index]
+            self._count = 0
+        return frames
+
+
+class FrameAcquirer(threading.Thread):
+    """
+    Background thread that continuously drains an ArduinoBoard into a
+    FrameBuffer so that slow consumers do not stall acquisition.
+
+    Parameters
+    ----------
+    board : ArduinoBoard()
+        Arduino from which data is gathered.
+    capacity : int
+        Number of frames held in the ring buffer.
+    batch : int
+        Number of frames requested from the board per serial read.
+
+    Attributes
+    ----------
+    buffer : FrameBuffer()
+        Ring buffer of acquired frames.
+    lock : threading.RLock()
+        Guards the serial port. Hold it while sending commands or changing the
+        board configuration so they do not interleave with a frame read.
+    frames : int
+        Total number of frames read from the board.
+    overruns : int
+        Number of serial reads that failed to return whole frames.
+    sinks : list
+        Callables passed (frames, sample_freq) for every read, e.g.
+        CaptureWriter.write. They run on the acquisition thread so must not block.
+        Hold lock while adding or removing sinks.
+    coalesced : int
+        Number of queued commands replaced or dropped as redundant.
+
+    Public Methods
+    --------------
+    send_command(self, message):
+        Sends a command to the board between frame reads, waiting for it to
+        be acknowledged.
+
+    queue_command(self, message, key=None):
+        Queues a command to be sent between frame reads without waiting.
+
+    set_led(self, pin):
+        Queues an LED command unless that LED is already lit.
+
+    stop(self):
+        Stops acquisition and waits for the thread to exit.
+    """
+
+    def __init__(self, board, capacity=64, batch=1):
+        super().__init__(daemon=True)
+        self.board = board
+        self.batch = batch
+        self.buffer = FrameBuffer(capacity, board.sample_no)
+        self.lock = threading.RLock()
+        self.frames = 0
+        self.overruns = 0
+        self.sinks = []
+        self.coalesced = 0
+        self._commands = collections.OrderedDict()  # key: message, sent in order
+        self._command_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        return
+
+    @property
+    def dropped(self):
+        return self.buffer.dropped
+
+    def run(self):
+        while not self._stop_event.is_set():
+            with self.lock:
+                try:
+                    frames = self.board.get_frames(self.batch)
+                except struct.error:
+                    self.overruns += 1
+                    print("[+] Unpacking error")
+                    continue
+                self.buffer.put(frames)
+                self.frames += len(frames)
+                for sink in self.sinks:
+                    sink(frames, self.board.sample_freq)
+                self._send_queued()
+        log.info("[+] Acquisition stopped after {} frames".format(self.frames))
+        return
+
+    def send_command(self, message):
+        """Sends a command to the board between frame reads, waiting for its acknowledgement."""
+        with self.lock:
+            self.board.send_command(message)
+        return
+
+    def queue_command(self, message, key=None):
+        """
+        Queues a command to be sent between frame reads and returns straight
+        away. A command queued with the same key as one still waiting replaces
+        it, so only the latest of a run of e.g. LED changes is sent.
+        """
+        with self._command_lock:
+            if key is None:
+                key = object()
+            elif key in self._commands:
+                self.coalesced += 1
+            self._commands[key] = message
+        return
+
+    def set_led(self, pin):
+        """Queues a command lighting the LED on pin, unless it is already lit."""
+        with self._command_lock:
+            if pin == self.board.LED:
+                # any queued change would be undone by this one, so drop both
+                self.coalesced += 1 + (self._commands.pop("LED", None) is not None)
+                return
+        self.queue_command(pin, key="LED")
+        return
+
+    def _send_queued(self):
+        with self._command_lock:
+            commands = list(self._commands.values())
+            self._commands.clear()
+        for message in commands:
+            if self.board.parser is None:
+                # raw samples carry no out of band acknowledgements
+                self.board.send_command(message)
+                continue
+            command = self.board.encode_command(message)
+            if command is not None:
+                self.board.write_command(*command)
+        if self.board.parser is not None:
+            self.board.collect_acks()
+        return
+
+    def stop(self):
+        """Stops acquisition and waits for the thread to exit."""
+        self._stop_event.set()
+        self.join()
+        return
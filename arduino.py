@@ -1,7 +1,144 @@
 import serial
 import logging as log
+import re
 import struct
+import time
+import binascii
+import collections
 import numpy as np
+from stats import STATS
+
+SYNC = b"\xa5\x5a"
+# sync word, sequence number, frame length, sample frequency
+HEADER = struct.Struct("<2sHHH")
+MAX_FRAME_LEN = 1024
+# seconds to wait for a command to be acknowledged
+ACK_TIMEOUT = 2.
+# printable text ending a line, which is all an acknowledgement can contain
+TEXT_LINE = re.compile(rb"[\x20-\x7e\r]*\n$")
+
+
+def frame_crc(data):
+    """CRC-16/XMODEM, as computed by the firmware's _crc_xmodem_update"""
+    return binascii.crc_hqx(data, 0)
+
+
+def pack_frame(seq, sample_freq, data):
+    """Returns the bytes the firmware sends for a frame of int8 samples"""
+    body = HEADER.pack(SYNC, seq & 0xFFFF, len(data), sample_freq) + bytes(data)
+    return body + struct.pack("<H", frame_crc(body[len(SYNC):]))
+
+
+class FrameParser:
+    """
+    Incremental parser for the framed serial protocol sent by the firmware.
+
+    Each frame is a sync word, a header holding the sequence number, frame
+    length and sample frequency, the int8 samples and a CRC-16 of everything
+    after the sync word. On a corrupt header or CRC the parser skips a byte and
+    searches for the next sync word, so it resynchronises within a frame of any
+    lost or corrupted bytes. Bytes outside frames are collected as text lines,
+    which is how command acknowledgements arrive. Acknowledgements are never
+    split across frames and are printable text, so any incomplete line is
+    discarded when a frame passes its CRC and binary debris is cut from the
+    front of each line, rather than either being joined onto the next
+    acknowledgement.
+
+    Attributes
+    ----------
+    lines : collections.deque
+        Complete text lines received between frames.
+    gaps : int
+        Number of frames missing from the sequence.
+    crc_errors : int
+        Number of candidate frames rejected by their CRC.
+    skipped : int
+        Number of bytes discarded outside frames and acknowledgements, e.g.
+        while resynchronising.
+
+    Public Methods
+    --------------
+    feed(self, data):
+        Adds received bytes to the parser.
+
+    frames(self):
+        Yields every complete frame received so far.
+    """
+
+    def __init__(self):
+        self.lines = collections.deque()
+        self.seq = None
+        self.gaps = 0
+        self.crc_errors = 0
+        self.skipped = 0
+        self._buffer = bytearray()
+        self._text = bytearray()
+        return
+
+    def feed(self, data):
+        """Adds received bytes to the parser"""
+        self._buffer.extend(data)
+
+    def _add_text(self, data):
+        self._text.extend(data)
+        while b"\n" in self._text:
+            end = self._text.index(b"\n") + 1
+            # binary debris from resynchronising is cut from the front of the line
+            line = TEXT_LINE.search(self._text[:end]).group()
+            self.skipped += end - len(line)
+            if line.strip():
+                self.lines.append(bytes(line))
+            else:
+                self.skipped += len(line)
+            del self._text[:end]
+
+    def _skip(self, n):
+        self._add_text(self._buffer[:n])
+        del self._buffer[:n]
+
+    def _reject(self):
+        # skip the sync byte of a corrupt candidate and search for the next one
+        self._skip(1)
+
+    def frames(self):
+        """Yields (seq, sample_freq, samples) for every complete frame received so far"""
+        buf = self._buffer
+        while True:
+            start = buf.find(SYNC)
+            if start < 0:
+                # keep a trailing half of the sync word for the next read
+                self._skip(len(buf) - 1 if buf.endswith(SYNC[:1]) else len(buf))
+                return
+            self._skip(start)
+            if len(buf) < HEADER.size:
+                return
+
+            _, seq, frame_len, sample_freq = HEADER.unpack_from(buf)
+            if not 0 < frame_len <= MAX_FRAME_LEN:
+                self._reject()
+                continue
+            end = HEADER.size + frame_len
+            if len(buf) < end + 2:
+                return
+            if frame_crc(buf[len(SYNC):end]) != struct.unpack_from("<H", buf, end)[0]:
+                self.crc_errors += 1
+                self._reject()
+                continue
+
+            # bytes still waiting for a newline are debris, not an acknowledgement
+            self.skipped += len(self._text)
+            self._text.clear()
+
+            if self.seq is not None and seq != (self.seq + 1) & 0xFFFF:
+                missing = (seq - self.seq - 1) & 0xFFFF
+                self.gaps += missing
+                STATS.count("frame_gaps", missing)
+                log.warning("[+] {} frames lost before frame {}".format(missing, seq))
+            self.seq = seq
+            samples = np.frombuffer(bytes(buf[HEADER.size:end]), dtype=np.int8)
+            del buf[:end + 2]
+            yield seq, sample_freq, samples
+
 
 class ArduinoBoard:
     """
@@ -16,11 +153,20 @@ class ArduinoBoard:
         baud rate of serial communications.
     timeout : int
         Connection timeout.
+    framed : bool
+        The firmware sends frames with a header and CRC, see FrameParser. Set
+        to False for firmware that sends raw samples.
 
     Attributes
     ----------
     board : serial.Serial()
         Serial connection to Arduino.
+    parser : FrameParser()
+        Parser for the framed protocol, None for raw samples.
+    acks : collections.deque
+        Commands, and the time they were sent, awaiting acknowledgement.
+    LED : int
+        Pin of the LED last commanded on.
     sample_no : int
         Number of samples in a frame.
     sample_freq : int
@@ -32,16 +178,37 @@ class ArduinoBoard:
         Initialises connection with Arduino and gathers samples metadata.
 
     send_command(self, message):
-        Sends the desired command to the Arduino.
+        Sends the desired command to the Arduino and waits for acknowledgement.
+
+    write_command(self, message, message_label=None):
+        Writes a command without waiting for its acknowledgement.
+
+    collect_acks(self, timeout=ACK_TIMEOUT):
+        Matches acknowledgements received alongside frames to written commands.
 
     get_data(self):
-        Reads data from the Arduino.
+        Reads a single frame of data from the Arduino.
+
+    get_frames(self, n):
+        Reads n consecutive frames from the Arduino.
+
+    readline(self, deadline=None):
+        Reads a line of text, such as a command acknowledgement, from the Arduino.
     """
 
-    def __init__(self, port, baud, timeout):
+    def __init__(self, port, baud, timeout, framed=True):
         self.board = serial.Serial(port, baud, timeout=timeout)
+        self.connect(framed)
+        return
+
+    def connect(self, framed=True):
+        """Runs setup over self.board and resets the receive state"""
         self.sample_no, self.sample_freq = self.setup()
         self.LED = 0  # current LED that is lit
+        self._buffer = bytearray()  # preallocated receive buffer for raw frames
+        self.parser = FrameParser() if framed else None
+        self._pending = collections.deque()  # frames parsed but not yet returned
+        self.acks = collections.deque()  # (command, time sent) awaiting acknowledgement
         return
 
     def setup(self):
@@ -63,9 +230,10 @@ class ArduinoBoard:
         log.info("[+] Sample freq: {}".format(sample_freq))
         return frame_len, sample_freq
 
-    def send_command(self, message):
+    def encode_command(self, message):
         """
-        Sends the desired command to the Arduino
+        Returns the command character and label for a message, given as a label,
+        a command character or an int, or None if the Arduino does not support it.
         """
         log.debug("send_command input: {}".format(message))
         message_dict = {"Standby": '1',
@@ -107,27 +275,172 @@ class ArduinoBoard:
         else:
             print("[+] ERROR: Message not configured on Arduino")
             return
+        return message, message_label
 
-        # send message
+    def write_command(self, message, message_label=None):
+        """
+        Writes a command character without waiting for its acknowledgement, which
+        is matched later by collect_acks or send_command.
+        """
         self.board.write(message.encode("utf-8"))
         log.info("[+] Message Sent: {} ({})".format(message_label, message))
-        line = self.board.readline()
-        # check confirmation:
+        self.acks.append((message, time.perf_counter()))
+        if message in "34567":
+            self.LED = int(message)
+        return
+
+    def send_command(self, message):
+        """
+        Sends the desired command to the Arduino and waits for it, and any
+        earlier commands, to be acknowledged.
+        """
+        command = self.encode_command(message)
+        if command is None:
+            return
+        self.write_command(*command)
+        deadline = time.perf_counter() + ACK_TIMEOUT
+        while self.acks:
+            line = self.readline(deadline)
+            if not line:
+                print("[+] ERROR: No acknowledgement for message:{}".format(command[0]))
+                STATS.count("command_timeouts", len(self.acks))
+                self.acks.clear()
+                break
+            self.match_ack(line)
+        return
+
+    def match_ack(self, line):
+        """
+        Matches an acknowledgement line to the oldest unacknowledged command,
+        recording the round trip time. Other lines are ignored.
+        """
         log.info("[+] Response: {}".format(line))
         try:
             line = str(line, "utf-8")
-            if message not in line:
-                print("[+] ERROR: Unable to acknowledge message:{}".format(line))
         except UnicodeDecodeError:
-            pass
+            return
+        starts = [line.find(token) for token in ("Recieved", "Command Not Found")]
+        starts = [start for start in starts if start >= 0]
+        if not starts:
+            return
+        line = line[min(starts):]
+        if not self.acks:
+            log.warning("[+] Unexpected acknowledgement: {}".format(line.strip()))
+            return
+        message, sent = self.acks.popleft()
+        STATS.add("command", time.perf_counter() - sent)
+        # check confirmation:
+        if message not in line:
+            print("[+] ERROR: Unable to acknowledge message:{}".format(line))
+        return
+
+    def collect_acks(self, timeout=ACK_TIMEOUT):
+        """
+        Matches any acknowledgements received alongside frames to the commands
+        sent with write_command, giving up on commands older than timeout seconds.
+        Only the framed protocol carries acknowledgements out of band.
+        """
+        if self.parser is None:
+            return
+        while self.parser.lines:
+            self.match_ack(self.parser.lines.popleft())
+        while self.acks and time.perf_counter() - self.acks[0][1] > timeout:
+            message, _ = self.acks.popleft()
+            STATS.count("command_timeouts")
+            print("[+] ERROR: No acknowledgement for message:{}".format(message))
         return
 
+    def readline(self, deadline=None):
+        """
+        Reads a line of text, such as a command acknowledgement, from the Arduino.
+        When framed, any frames received before the line are kept for get_frames,
+        and b"" is returned if no line arrives before the time.perf_counter()
+        deadline, even while frames keep streaming.
+        """
+        if self.parser is None:
+            return self.board.readline()
+        while not self.parser.lines:
+            if deadline is not None and time.perf_counter() > deadline:
+                return b""
+            data = self.board.read(max(self.board.in_waiting, 1))
+            if not data:
+                return b""
+            self.parser.feed(data)
+            self._pending.extend(self.parser.frames())
+        return self.parser.lines.popleft()
+
     def get_data(self):
-        """Reads data from the Arduino"""
-        data = self.board.read(self.sample_no)
-        try:
-            data = np.array(struct.unpack('b'*self.sample_no, data))
-        except struct.error as e:
-            print(data)
-            raise e
-        return data
+        """
+        Reads a single frame of data from the Arduino.
+
+        For raw samples the returned int8 array is a view onto the board's
+        receive buffer and is overwritten by the next read, so copy it if it
+        must be kept.
+        """
+        return self.get_frames(1)[0]
+
+    def get_frames(self, n):
+        """
+        Reads n consecutive frames from the Arduino in as few serial reads as
+        possible.
+
+        When framed, sample_no and sample_freq follow the frame headers, and
+        fewer than n frames are returned if the read times out or the frame
+        length or sample frequency changes part way through.
+
+        Parameters
+        ----------
+        n : int
+            Number of frames to read.
+
+        Returns
+        -------
+        frames : np.ndarray
+            (n, sample_no) int8 array of frames.
+        """
+        if self.parser is None:
+            return self.get_raw_frames(n)
+
+        frames = []
+        with STATS.timer("serial_read"):
+            while len(frames) < n:
+                if not self._pending:
+                    need = (n - len(frames))*(self.sample_no + HEADER.size + 2)
+                    data = self.board.read(need)
+                    if not data:
+                        break
+                    self.parser.feed(data)
+                    self._pending.extend(self.parser.frames())
+                    continue
+
+                seq, sample_freq, samples = self._pending[0]
+                if (len(samples), sample_freq) != (self.sample_no, self.sample_freq):
+                    if frames:
+                        break
+                    log.info("[+] Frame length {}, sample freq {}".format(len(samples), sample_freq))
+                    self.sample_no, self.sample_freq = len(samples), sample_freq
+                frames.append(samples)
+                self._pending.popleft()
+
+        STATS.count("frames", len(frames))
+        if not frames:
+            raise struct.error("no frames recieved before timeout")
+        return np.stack(frames)
+
+    def get_raw_frames(self, n):
+        """
+        Reads n consecutive frames of raw samples from the Arduino in a single
+        serial read, returning an (n, sample_no) int8 view onto the board's
+        receive buffer that is valid until the next read.
+        """
+        size = n*self.sample_no
+        if len(self._buffer) < size:
+            self._buffer = bytearray(size)
+        view = memoryview(self._buffer)[:size]
+        with STATS.timer("serial_read"):
+            read = self.board.readinto(view)
+        STATS.count("frames", read//self.sample_no)
+        if read != size:
+            print(bytes(view[:read]))
+            raise struct.error("expected {} bytes, recieved {}".format(size, read))
+        return np.frombuffer(self._buffer, dtype=np.int8, count=size).reshape(n, self.sample_no)
@@ -0,0 +1,116 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from capture import CaptureReader
+from data_logger import DataLogger
+
+
+def analyse(path, out_dir, match=False, spec_size=100):
+    """
+    Runs the DataLogger pipeline over a capture as fast as possible, writing the
+    per-frame peaks and tuning to <name>.csv, the spectrogram of each run of
+    frames with the same configuration to <name>_spec<n>.npy and, if match is
+    set, the best matching recording for every spec_size frames to
+    <name>_matches.csv.
+
+    Returns a dict summarising the run.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    reader = CaptureReader(path)
+    # counted from the chunk headers, so a capture that was never closed is sized correctly
+    lengths = reader.segment_lengths()
+
+    start = time.perf_counter()
+    logger = None
+    frame = 0
+    t = 0.
+    specgram = None
+    segment = -1
+    matches = []
+    with open(os.path.join(out_dir, name + ".csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["frame", "time", "sample_freq", "frame_len", "freq_peak", "note", "LED"])
+        for frames, sample_freq in reader.chunks():
+            frame_len = frames.shape[1]
+            if logger is None:
+                logger = DataLogger(frame_len, sample_freq, spec_size=spec_size)
+            if (logger.sample_freq, logger.frame_len) != (sample_freq, frame_len) or specgram is None:
+                logger.set_sample_freq(sample_freq)
+                logger.set_frame_len(frame_len)
+                segment += 1
+                specgram = np.lib.format.open_memmap(
+                    os.path.join(out_dir, "{}_spec{}.npy".format(name, segment)), mode="w+",
+                    shape=(lengths[segment], frame_len//2 + 1))
+                row = 0
+                # the spectrogram was cleared, so matching windows restart with the segment
+                logger.record_counter = 0
+
+            first = 0
+            while first < len(frames):
+                # end each piece where a matching window fills, so the spectrogram
+                # matched is exactly the window it is reported for
+                end = len(frames)
+                if match:
+                    end = min(end, first + spec_size - logger.record_counter)
+                sp_data, psd, freq_peak, wf_data = logger.process_batch(frames[first:end])
+                specgram[row:row + len(psd)] = psd
+                row += len(psd)
+
+                for peak in freq_peak:
+                    logger.freq_peak = peak
+                    tuning = logger.tune()
+                    note, LED = tuning[1:] if tuning is not None else ('', '')
+                    writer.writerow([frame, t, sample_freq, frame_len, peak, note, LED])
+                    frame += 1
+                    t += frame_len/sample_freq
+
+                logger.record_counter += end - first
+                first = end
+                if match and logger.record_counter >= spec_size:
+                    logger.record_counter = 0
+                    scores = logger.score_matches()
+                    if scores:
+                        best = max(scores, key=scores.get)
+                        matches.append([frame - spec_size, best, scores[best]])
+
+    if match:
+        with open(os.path.join(out_dir, name + "_matches.csv"), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["frame", "match", "mssim"])
+            writer.writerows(matches)
+
+    elapsed = time.perf_counter() - start
+    return dict(file=path, frames=frame, seconds=elapsed, fps=frame/elapsed if elapsed else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analyse recorded captures without a board or display")
+    parser.add_argument("captures", nargs="+", help="capture files written by CaptureWriter")
+    parser.add_argument("--out", default="./analysis", help="directory results are written to")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes, defaults to the number of cores")
+    parser.add_argument("--match", action="store_true",
+                        help="match every spectrogram window against ./record_files")
+    parser.add_argument("--spec-size", type=int, default=100, help="rows per spectrogram window")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    start = time.perf_counter()
+    frames = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(analyse, path, args.out, args.match, args.spec_size)
+                   for path in args.captures]
+        for future in as_completed(futures):
+            result = future.result()
+            frames += result["frames"]
+            print("[+] {file}: {frames} frames in {seconds:.2f} s ({fps:.0f} frames/s)".format(**result))
+
+    elapsed = time.perf_counter() - start
+    print("[+] Total: {} frames in {:.2f} s ({:.0f} frames/s)".format(frames, elapsed, frames/elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import io
+import os
+import sys
+import json
+import itertools
+import collections
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import subprocess
+import numpy as np
+from arduino import ArduinoBoard, FrameParser, pack_frame
+from data_logger import DataLogger
+from record_store import RecordStore
+from simulator import ToneSource
+
+FRAME_LENS = (256, 512, 800, 1024)
+SAMPLE_FREQS = (4000, 7000, 9000)
+
+
+def measure(func, number, repeat=5):
+    """Returns the median time per call of func, in microseconds, over repeat runs"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start)/number)
+    return float(np.median(times))*1e6
+
+
+def frames(sample_freq, frame_len, n):
+    """Returns n consecutive frames of a noisy two tone signal"""
+    source = ToneSource((440, 1250), noise=5, seed=0)
+    return source.read(n*frame_len, sample_freq).reshape(n, frame_len)
+
+
+def bench_process(number):
+    results = dict()
+    for sample_freq in SAMPLE_FREQS:
+        for frame_len in FRAME_LENS:
+            data = frames(sample_freq, frame_len, 64)
+            logger = DataLogger(frame_len, sample_freq)
+            rows = itertools.cycle(data)
+            results["process/{}/{}".format(sample_freq, frame_len)] = measure(
+                lambda: logger.process(next(rows)), number)
+            results["process_batch64/{}/{}".format(sample_freq, frame_len)] = measure(
+                lambda: logger.process_batch(data), max(number//64, 1))/len(data)
+            logger.set_hop(frame_len//4)
+            results["process_batch64_hop4/{}/{}".format(sample_freq, frame_len)] = measure(
+                lambda: logger.process_batch(data), max(number//64, 1))/len(data)
+    return results
+
+
+def bench_tune(number):
+    logger = DataLogger(1024, 4000)
+    peaks = itertools.cycle(np.random.default_rng(0).uniform(logger.freq_lo, 2000, 1000))
+
+    def tune():
+        logger.freq_peak = next(peaks)
+        logger.tune()
+    results = {"tune": measure(tune, number)}
+    results["get_tuning_freq"] = measure(lambda: logger.get_tuning_freq(next(peaks)), number)
+    return results
+
+
+def bench_decode(number):
+    results = dict()
+    for frame_len in FRAME_LENS:
+        data = np.random.default_rng(0).integers(-128, 128, (256, frame_len), dtype=np.int8)
+        for name, framed in (("", False), ("framed_", True)):
+            board = ArduinoBoard.__new__(ArduinoBoard)
+            board.sample_no, board.sample_freq = frame_len, 4000
+            board._buffer = bytearray()
+            board.parser = FrameParser() if framed else None
+            board._pending = collections.deque()
+            if framed:
+                stream = b"".join(pack_frame(i, 4000, row.tobytes()) for i, row in enumerate(data))
+            else:
+                stream = data.tobytes()
+            board.board = io.BytesIO(stream)
+            board.board.in_waiting = 0
+
+            def read(n, board=board, stream=stream):
+                if board.board.tell() > len(stream)*(1 - n/len(data)):
+                    board.board.seek(0)
+                    if board.parser is not None:
+                        board.parser.seq = None
+                board.get_frames(n)
+            results["{}get_data/{}".format(name, frame_len)] = measure(lambda: read(1), number)
+            results["{}get_frames16/{}".format(name, frame_len)] = measure(
+                lambda: read(16), max(number//16, 1))/16
+    return results
+
+
+def bench_match(sizes, repeat):
+    results = dict()
+    rng = np.random.default_rng(0)
+    sample_freq, frame_len, spec_size = 4000, 256, 100
+    for size in sizes:
+        directory = tempfile.mkdtemp(prefix="bench_records_")
+        try:
+            store = RecordStore(directory + "/records.spec")
+            base = rng.uniform(20, 80, (spec_size, frame_len//2 + 1))
+            store.append_many([("synthetic{}".format(i),
+                                base + rng.normal(0, 5, base.shape), sample_freq, frame_len,
+                                spec_size) for i in range(size)])
+
+            logger = DataLogger(frame_len, sample_freq, spec_size=spec_size,
+                                record_dir=directory)
+            logger.specgram.push_many(base)
+            start = time.perf_counter()
+            logger.score_matches()  # fingerprints the whole library
+            results["match_cold/{}".format(size)] = (time.perf_counter() - start)*1e6
+            results["match/{}".format(size)] = measure(logger.score_matches, 1, repeat)
+        finally:
+            shutil.rmtree(directory)
+    return results
+
+
+# tuning-only headless start: import, set up a logger and process one frame
+FIRST_FRAME = """
+import time
+start = time.perf_counter()
+import numpy as np
+from data_logger import DataLogger
+logger = DataLogger(1024, 4000)
+logger.process(np.zeros(1024, dtype=np.int8))
+logger.tune()
+print(time.perf_counter() - start)
+"""
+
+
+def bench_startup(repeat=3):
+    """
+    Times a cold, tuning-only start to the first processed frame in a fresh
+    interpreter, and breaks down the time spent importing each top level package.
+    """
+    # the modules are imported from the directory holding this file
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = dict()
+    first_frame = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", FIRST_FRAME], capture_output=True,
+                             text=True, check=True, cwd=directory)
+        first_frame.append(float(out.stdout.split()[-1]))
+    results["startup/first_frame"] = float(np.median(first_frame))*1e6
+
+    # python -X importtime reports the time each module took to import itself in us
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import data_logger"],
+                         capture_output=True, text=True, check=True, cwd=directory)
+    for line in out.stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            name = "startup/import/{}".format(fields[2].strip().split(".")[0])
+            results[name] = results.get(name, 0) + int(fields[0])
+    # leave out packages that take under a millisecond
+    return dict((name, value) for name, value in results.items() if value >= 1000)
+
+
+def compare(results, baseline, threshold):
+    """Prints the ratio of each result to the baseline, returning the regressions"""
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            print("{:<34}{:>14.2f} us".format(name, value))
+            continue
+        ratio = value/baseline[name]
+        flag = ""
+        if ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("{:<34}{:>14.2f} us {:>7.2f}x{}".format(name, value, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the DSP, decoding and matching paths")
+    parser.add_argument("--out", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown relative to the baseline reported as a regression")
+    parser.add_argument("--number", type=int, default=200, help="calls per timing run")
+    parser.add_argument("--library", type=int, nargs="+", default=[10, 100, 1000],
+                        help="library sizes to match against, e.g. 10 100 1000 10000")
+    parser.add_argument("--only", nargs="+",
+                        choices=["process", "tune", "decode", "match", "startup"],
+                        help="only run these benchmarks")
+    args = parser.parse_args()
+
+    suites = dict(process=lambda: bench_process(args.number),
+                  tune=lambda: bench_tune(args.number),
+                  decode=lambda: bench_decode(args.number),
+                  match=lambda: bench_match(args.library, 3),
+                  startup=bench_startup)
+    results = dict()
+    for name, suite in suites.items():
+        if args.only is None or name in args.only:
+            results.update(suite())
+
+    baseline = dict()
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(dict(time=time.time(), python=platform.python_version(),
+                           numpy=np.__version__, machine=platform.machine(),
+                           results=results), f, indent=2)
+    if regressions:
+        print("[+] {} regressions over {}x".format(len(regressions), args.threshold))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
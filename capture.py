@@ -0,0 +1,230 @@
+import os
+import json
+import zlib
+import queue
+import struct
+import threading
+import logging as log
+import numpy as np
+
+MAGIC = b"CHNK"
+# magic, number of frames, frame length, compressed flag, payload length
+CHUNK = struct.Struct("<4sIHHI")
+
+
+class CaptureWriter:
+    """
+    Streams raw int8 frames to disk from a background thread, so that long
+    sessions can be captured in constant memory.
+
+    Frames are grouped into chunks, optionally zlib compressed, each with a
+    small header giving its frame count and length. A JSON sidecar next to the
+    capture records the sample frequency and frame length of each run of
+    frames, and is rewritten with every chunk so a capture that is never
+    closed can still be read back up to its last complete chunk.
+
+    Parameters
+    ----------
+    path : str
+        File the capture is written to. The sidecar is written to path + ".json".
+    compress : bool
+        Compress each chunk with zlib.
+    chunk_frames : int
+        Maximum number of frames written per chunk.
+    queue_size : int
+        Maximum number of frames waiting to be written before new frames are
+        dropped.
+
+    Attributes
+    ----------
+    frames : int
+        Number of frames written.
+    dropped : int
+        Number of frames dropped because the writer fell behind.
+
+    Public Methods
+    --------------
+    write(self, frames, sample_freq):
+        Queues frames to be written without blocking.
+
+    close(self):
+        Writes any queued frames and closes the capture.
+    """
+
+    def __init__(self, path, compress=False, chunk_frames=64, queue_size=256):
+        self.path = path
+        self.compress = compress
+        self.chunk_frames = chunk_frames
+        self.frames = 0
+        self.dropped = 0
+        self.segments = []
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._chunk = []
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "wb")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return
+
+    def write(self, frames, sample_freq):
+        """Queues a frame, or an (n, frame_len) array of frames, to be written"""
+        for frame in np.atleast_2d(frames):
+            try:
+                self._queue.put_nowait((frame.tobytes(), sample_freq))
+            except queue.Full:
+                self.dropped += 1
+        return
+
+    def close(self):
+        """Writes any queued frames and closes the capture"""
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        log.info("[+] Captured {} frames to {}, {} dropped".format(self.frames, self.path,
+                                                                    self.dropped))
+        return
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            frame, sample_freq = item
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or (sample_freq, len(frame)) != (segment["sample_freq"],
+                                                                segment["frame_len"]):
+                self._flush()
+                self.segments.append(dict(frame=self.frames, sample_freq=sample_freq,
+                                          frame_len=len(frame)))
+                self._write_sidecar()
+
+            self._chunk.append(frame)
+            self.frames += 1
+            if len(self._chunk) >= self.chunk_frames:
+                self._flush()
+        self._flush()
+        return
+
+    def _flush(self):
+        if not self._chunk:
+            return
+        payload = b"".join(self._chunk)
+        if self.compress:
+            payload = zlib.compress(payload, 1)
+        self._file.write(CHUNK.pack(MAGIC, len(self._chunk), len(self._chunk[0]),
+                                    int(self.compress), len(payload)))
+        self._file.write(payload)
+        self._file.flush()
+        self._chunk = []
+        self._write_sidecar()
+
+    def _write_sidecar(self):
+        # frames in the chunk being built are not on disk yet
+        tmp = self.path + ".json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(dict(compress=self.compress, frames=self.frames - len(self._chunk),
+                           segments=self.segments), f)
+        os.replace(tmp, self.path + ".json")
+
+
+class CaptureReader:
+    """
+    Reads back a capture written by CaptureWriter one chunk at a time.
+
+    Parameters
+    ----------
+    path : str
+        File the capture was written to.
+
+    Attributes
+    ----------
+    frames : int
+        Number of frames in the complete chunks of the capture.
+    segments : list of dict
+        Index of the first frame, sample frequency and frame length of each
+        run of frames with the same configuration.
+
+    Public Methods
+    --------------
+    chunks(self):
+        Yields (frames, sample_freq) for each chunk in the capture.
+
+    samples(self):
+        Returns every captured sample as a single int8 array.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + ".json") as f:
+            sidecar = json.load(f)
+        self.segments = sidecar["segments"]
+        # the sidecar is only as current as the last chunk written before the
+        # capture was closed or interrupted, so the frames are counted from the chunks
+        self.frames = sum(n_frames for n_frames, _, _, _ in self._headers())
+        return
+
+    def __iter__(self):
+        return self.chunks()
+
+    def segment_lengths(self):
+        """Returns the number of frames in each run of chunks with the same configuration"""
+        # counted from the chunks, as the sidecar may be behind the capture
+        lengths = []
+        config = None
+        frame = 0
+        for n_frames, frame_len, _, _ in self._headers():
+            if (self.sample_freq(frame), frame_len) != config:
+                config = (self.sample_freq(frame), frame_len)
+                lengths.append(0)
+            lengths[-1] += n_frames
+            frame += n_frames
+        return lengths
+
+    def sample_freq(self, frame):
+        """Returns the sample frequency the given frame was captured at"""
+        freq = None
+        for segment in self.segments:
+            if segment["frame"] > frame:
+                break
+            freq = segment["sample_freq"]
+        return freq
+
+    def _headers(self, f=None):
+        # yields (n_frames, frame_len, compressed, size) for each complete chunk,
+        # leaving f at its payload, and stops at a chunk cut short by an interruption
+        if f is None:
+            with open(self.path, "rb") as f:
+                yield from self._headers(f)
+            return
+        length = os.fstat(f.fileno()).st_size
+        while True:
+            start = f.tell()
+            header = f.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return
+            magic, n_frames, frame_len, compressed, size = CHUNK.unpack(header)
+            if magic != MAGIC:
+                raise ValueError("Corrupt chunk at byte {} of {}".format(start, self.path))
+            if f.tell() + size > length:
+                return
+            yield n_frames, frame_len, compressed, size
+            f.seek(start + CHUNK.size + size)
+
+    def chunks(self):
+        """Yields an (n, frame_len) int8 array and its sample frequency for each chunk"""
+        frame = 0
+        with open(self.path, "rb") as f:
+            for n_frames, frame_len, compressed, size in self._headers(f):
+                payload = f.read(size)
+                if compressed:
+                    payload = zlib.decompress(payload)
+                frames = np.frombuffer(payload, dtype=np.int8).reshape(n_frames, frame_len)
+                yield frames, self.sample_freq(frame)
+                frame += n_frames
+
+    def samples(self):
+        """Returns every captured sample as a single int8 array"""
+        return np.concatenate([frames.ravel() for frames, _ in self.chunks()])
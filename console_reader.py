@@ -1,14 +1,21 @@
+import time
+# startup is reported as the time from here to the first processed frame
+START = time.perf_counter()
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
+QT_LOADED = time.perf_counter()
 import numpy as np
-import scipy.signal as sp
 import sys
+import signal
+import threading
 import logging as log
-import struct
-import imagehash
-from PIL import Image
 from arduino import ArduinoBoard
+from acquisition import FrameAcquirer
 from data_logger import DataLogger
+from dsp import warm_plans
+from matching import MatchPool
+from capture import CaptureWriter
+from stats import STATS, StatsReporter
 
 class SpectrumGUI:
     """
@@ -17,12 +24,17 @@ class SpectrumGUI:
 
     Parameters
     ----------
-    None
+    port : str
+        Port that the Arduino is connected to, e.g. a pty served by simulator.py.
+    match_workers : int
+        Number of processes used to match recordings, defaults to the number of cores.
 
     Attributes
     ----------
     board : ArduinoBoard()
         Arduino from which data is gathered.
+    acquirer : FrameAcquirer()
+        Background thread buffering frames from the board.
     sample_no : int
         Number of samples in a frame.
     sample_freq : int
@@ -50,21 +62,40 @@ class SpectrumGUI:
         Sets the data for the give plot name.
 
     update(self):
-        Gathers new data and updates all the plots.
+        Processes the buffered frames.
+
+    render(self):
+        Redraws the plots if new frames have been processed since the last redraw.
+
+    stop_capture(self):
+        Stops sending frames to the capture in progress, if any, and closes it.
+
+    close(self):
+        Closes any capture in progress and stops acquisition and matching.
 
     spectrogram_update(self, sp_data):
         Updates the spectrogram plot
     """
 
-    def __init__(self):
-        self.board = ArduinoBoard("/dev/ttyACM0", 230400, timeout=5)
+    def __init__(self, port="/dev/ttyACM0", match_workers=None):
+        self.board = ArduinoBoard(port, 230400, timeout=5)
         self.data_analyser = DataLogger(self.board.sample_no, self.board.sample_freq)
         self.f, self.x = self.data_analyser.set_sample_freq(self.board.sample_freq)
 
         self.mode = None
+        self.match_workers = match_workers
+        self.match_pool = None  # started when compare mode is first used
+        self.capture = None
         self.xscale = 1
         self.yscale = 1
 
+        # latest processed data, drawn by render() at the display rate
+        self.wf_data = None
+        self.sp_data = None
+        self.dirty = False
+        self.levels = (20*np.log10(10), 20*np.log10(10000))
+        self.img_data = None
+
         # pyqtgraph stuff
         pg.setConfigOptions(antialias=True)
         self.traces = dict()
@@ -91,14 +122,37 @@ class SpectrumGUI:
         cmap = pg.ColorMap(pos, color)
         lut = cmap.getLookupTable(0.0, 1.0, 256)
 
+        # the spectrogram is scaled to uint8 before display, so the LUT maps it directly
         self.img.setLookupTable(lut)
-        self.img.setLevels([20*np.log10(10), 20*np.log10(10000)])
+        self.img.setLevels([0, 255])
 
         # waveform and spectrum x points
         self.scale_plots()
 
-        # tell Arduino to start sending data
+        # tell Arduino to start sending data, then drain it in the background
         self.board.send_command("Send Data")
+        self.acquirer = FrameAcquirer(self.board)
+        self.acquirer.start()
+        self.first_frame = False
+
+        # design the filters for every other board configuration off the GUI thread
+        threading.Thread(target=warm_plans, daemon=True,
+                         args=(self.data_analyser.freq_lo, self.data_analyser.freq_hi)).start()
+        STATS.add("import:pyqtgraph", QT_LOADED - START)
+
+        self.stats_reporter = None
+        STATS.gauge("dropped", lambda: self.acquirer.dropped)
+        STATS.gauge("overruns", lambda: self.acquirer.overruns)
+        STATS.gauge("capture_drop", lambda: self.capture.dropped if self.capture else 0)
+        if self.board.parser is not None:
+            STATS.gauge("crc_errors", lambda: self.board.parser.crc_errors)
+        STATS.gauge("coalesced", lambda: self.acquirer.coalesced)
+        STATS.gauge("unacked", lambda: len(self.board.acks))
+
+        # a capture left open when the window closes would lose its last chunk,
+        # so Ctrl-C quits the event loop rather than interrupting it
+        self.app.aboutToQuit.connect(self.close)
+        signal.signal(signal.SIGINT, lambda *args: self.app.quit())
 
     def keyPressed(self, evt):
         """
@@ -114,18 +168,19 @@ class SpectrumGUI:
         else:
             msg = int(msg)
         if msg in {0, 8, 9}:
-            if msg == 0:
-                self.f, self.x = self.data_analyser.set_sample_freq(4000)
-                self.board.sample_freq = 4000
-            elif msg == 8:
-                self.f, self.x = self.data_analyser.set_sample_freq(7000)
-                self.board.sample_freq = 7000
-            elif msg == 9:
-                self.f, self.x = self.data_analyser.set_sample_freq(9000)
-                self.board.sample_freq = 9000
+            with self.acquirer.lock:
+                if msg == 0:
+                    self.f, self.x = self.data_analyser.set_sample_freq(4000)
+                    self.board.sample_freq = 4000
+                elif msg == 8:
+                    self.f, self.x = self.data_analyser.set_sample_freq(7000)
+                    self.board.sample_freq = 7000
+                elif msg == 9:
+                    self.f, self.x = self.data_analyser.set_sample_freq(9000)
+                    self.board.sample_freq = 9000
 
-            self.scale_plots()
-            self.board.send_command(msg)
+                self.scale_plots()
+                self.board.send_command(msg)
 
     def txt_command(self, cmd):
         """Converts a text based input into a command to send to the board."""
@@ -136,6 +191,12 @@ class SpectrumGUI:
             print("filt   <frequency kHz> - sets the low pass digital filter frequency < 4.5kHz")
             print("sample <frequency kHz> - sets the sampling frequency of 4kHz, 7kHz, or 9kHz")
             print("frame  <frame length>  - number of samples per frame {256, 512, 800, 1024}")
+            print("hop    <samples>|off   - overlapping spectrogram rows every <samples> samples")
+            print("mode listen            - identifies the recording being played as it plays")
+            print("capture <name> [z]     - stream raw frames to ./captures/<name>.cap, z compresses")
+            print("capture stop           - stops the current capture")
+            print("stats [dump <file>]    - prints per-stage timings, or writes them as JSON")
+            print("stats log <s> [file]   - prints, and optionally dumps, the stats every s seconds")
 
         elif cmd[0] == 'mode':
             if cmd[1] == 'record':
@@ -145,6 +206,8 @@ class SpectrumGUI:
                     print("Record/ Compare must have filename supplied")
                     return
             if cmd[1] == 'compare':
+                if self.match_pool is None:
+                    self.match_pool = MatchPool(self.match_workers)
                 try:
                     self.file_name = cmd[2]
                 except IndexError:
@@ -154,9 +217,41 @@ class SpectrumGUI:
                 except IndexError:
                     self.cmp_name = None
 
+            # a match still running belongs to the previous mode
+            self.data_analyser.cancel_match()
+            self.data_analyser.listener = None
             self.mode = cmd[1]
             return
 
+        elif cmd[0] == 'capture':
+            if len(cmd) < 2:
+                print("Capture must have a name or stop supplied")
+                return
+            self.stop_capture()
+            if cmd[1] != 'stop':
+                self.capture = CaptureWriter("./captures/{}.cap".format(cmd[1]),
+                                             compress='z' in cmd[2:])
+                with self.acquirer.lock:
+                    self.acquirer.sinks.append(self.capture.write)
+
+        elif cmd[0] == 'stats':
+            if len(cmd) == 1:
+                print(STATS.report())
+            elif cmd[1] == 'dump' and len(cmd) > 2:
+                STATS.dump(cmd[2])
+            elif cmd[1] == 'log':
+                if self.stats_reporter is not None:
+                    self.stats_reporter.stop()
+                    self.stats_reporter = None
+                try:
+                    interval = float(cmd[2])
+                except (IndexError, ValueError):
+                    print("Stats logging stopped")
+                    return
+                path = cmd[3] if len(cmd) > 3 else None
+                self.stats_reporter = StatsReporter(STATS, interval, path)
+                self.stats_reporter.start()
+
         elif cmd[0] == 'filter':
             try:
                 new_fc = int(cmd[1])
@@ -172,14 +267,14 @@ class SpectrumGUI:
                 cmd = int(cmd[1])
                 if cmd not in {4, 7, 9}:
                     raise ValueError()
-                else:
-                    self.f, self.x = self.data_analyser.set_sample_freq(cmd*1000)
-                    self.board.sample_freq = cmd*1000
             except ValueError:
                 print("Sample rate must be 4, 7, or 9 kHz")
                 return
 
-            self.board.send_command("Sample {}k".format(int(cmd)))
+            with self.acquirer.lock:
+                self.f, self.x = self.data_analyser.set_sample_freq(cmd*1000)
+                self.board.sample_freq = cmd*1000
+                self.board.send_command("Sample {}k".format(int(cmd)))
             self.scale_plots()
 
         elif cmd[0] == 'frame':
@@ -187,15 +282,24 @@ class SpectrumGUI:
                 cmd = int(cmd[1])
                 if cmd not in {256, 512, 800, 1024}:
                     raise ValueError()
-                else:
-                    self.f, self.x = self.data_analyser.set_frame_len(cmd)
-                    self.board.sample_no = cmd
-                self.board.send_command("Frame {}".format(cmd))
-                self.scale_plots()
             except ValueError:
                 print("Frame length must be 256, 512, 800, 1024")
                 return
 
+            with self.acquirer.lock:
+                self.f, self.x = self.data_analyser.set_frame_len(cmd)
+                self.board.sample_no = cmd
+                self.board.send_command("Frame {}".format(cmd))
+            self.scale_plots()
+
+        elif cmd[0] == 'hop':
+            try:
+                self.data_analyser.set_hop(None if cmd[1] == 'off' else int(cmd[1]))
+            except (IndexError, ValueError):
+                print("Hop must be off or between 1 and the frame length {}".format(
+                    self.data_analyser.frame_len))
+                return
+
     def scale_plots(self):
         """Scales the figures based on the current sampling frequency"""
         self.waveform.setXRange(0, self.x.max(), padding=0.005)
@@ -209,6 +313,9 @@ class SpectrumGUI:
         self.xscale *= xscale
         self.yscale *= yscale
 
+        # the last processed frame no longer matches the axes, so wait for a new one
+        self.dirty = False
+
     def set_plotdata(self, name, data_x, data_y):
         """Sets the data for the given plot name"""
         if name in self.traces:
@@ -220,43 +327,124 @@ class SpectrumGUI:
             if name == 'spectrum':
                 self.traces[name] = self.spectrum.plot(pen='m', width=3)
                 self.spectrum.setYRange(0, 10000, padding=0)
+            # only draw about one point per pixel, keeping the peaks visible
+            self.traces[name].setDownsampling(auto=True, method='peak')
+            self.traces[name].setClipToView(True)
 
-    def update(self):
-        """Gathers new data and updates all the plots"""
-        try:
-            wf_data = self.board.get_data()
-        except struct.error:
-            print("[+] Unpacking error")
-            return
+    def spectrogram_image(self):
+        """
+        Returns the spectrogram transposed and scaled to uint8 for the lookup
+        table, reusing the image buffers between frames.
+        """
+        specgram = self.data_analyser.get_specgram().T
+        if self.img_data is None or self.img_data[0].shape != specgram.shape:
+            self.img_data = (np.empty(specgram.shape, dtype=np.float32),
+                             np.empty(specgram.shape, dtype=np.uint8))
+        scaled, image = self.img_data
+
+        lo, hi = self.levels
+        np.subtract(specgram, lo, out=scaled, casting='unsafe')
+        scaled *= 255/(hi - lo)
+        np.clip(scaled, 0, 255, out=scaled)
+        np.copyto(image, scaled, casting='unsafe')
+        return image
 
-        sp_data, wf_data = self.data_analyser.process(wf_data)
+    def update(self):
+        """Processes the buffered frames"""
+        self.data_analyser.poll_match()
 
+        frames = self.acquirer.buffer.get_all()
+        # skip frames read before a frame length change took effect
+        if len(frames) == 0 or frames.shape[1] != self.data_analyser.frame_len:
+            return
 
-        self.set_plotdata(name='waveform', data_x=self.x, data_y=wf_data,)
-        self.set_plotdata(name='spectrum', data_x=self.f, data_y=sp_data)
-        self.img.setImage(self.data_analyser.get_specgram().T,
-                          autoLevels=False)
+        first = 0
+        while first < len(frames):
+            # end each piece on the row that fills a recording or comparison, so the
+            # spectrogram saved or matched does not include later rows. With a hop
+            # set this is to within the rows of one frame
+            end = len(frames)
+            if self.mode in ('record', 'compare'):
+                rows = self.data_analyser.spec_size + 1 - self.data_analyser.record_counter
+                end = min(end, first + self.data_analyser.frames_for_rows(rows))
+            sp_data, psd, peaks, wf_data = self.data_analyser.process_batch(frames[first:end])
+            first = end
+
+            # recordings and comparisons count spectrogram rows
+            for _ in psd:
+                if self.mode == 'record':
+                    if self.data_analyser.record(self.file_name):
+                        self.mode = 'standby'
+
+                elif self.mode == 'compare':
+                    if self.data_analyser.audio_match(self.file_name, self.cmp_name,
+                                                      pool=self.match_pool):
+                        self.mode = 'standby'
+
+            if self.mode == 'listen':
+                if self.data_analyser.listen(psd) is not None:
+                    self.mode = 'standby'
+
+        self.sp_data, self.wf_data = sp_data[-1], wf_data[-1]
+        self.dirty = True
+        if not self.first_frame:
+            self.first_frame = True
+            STATS.add("first_frame", time.perf_counter() - START)
+            log.info("[+] First frame processed {:.2f} s after start".format(
+                time.perf_counter() - START))
 
         if self.mode == 'tune':
-            peak, note, LED = self.data_analyser.tune()
-            self.board.send_command(int(LED+3))
-        elif self.mode == 'record':
-            if self.data_analyser.record(self.file_name):
-                self.mode = 'standby'
-
-        elif self.mode == 'compare':
-            if self.data_analyser.audio_match(self.file_name, self.cmp_name):
-                self.mode = 'standby'
-
-    def animation(self):
+            tuning = self.data_analyser.tune()
+            if tuning is not None:
+                peak, note, LED = tuning
+                self.acquirer.set_led(int(LED+3))
+
+    def render(self):
+        """Redraws the plots if new frames have been processed since the last redraw"""
+        if not self.dirty:
+            return
+        with STATS.timer("render"):
+            self.set_plotdata(name='waveform', data_x=self.x, data_y=self.wf_data,)
+            self.set_plotdata(name='spectrum', data_x=self.f, data_y=self.sp_data)
+            self.img.setImage(self.spectrogram_image(), autoLevels=False)
+        self.dirty = False
+
+    def animation(self, render_interval=33):
+        # processing keeps up with acquisition, drawing runs at the display rate
         timer = QtCore.QTimer()
         timer.timeout.connect(self.update)
         timer.start(20)
+        render_timer = QtCore.QTimer()
+        render_timer.timeout.connect(self.render)
+        render_timer.start(render_interval)
         self.start()
 
     def start(self):
         if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
-            QtGui.QApplication.instance().exec_()
+            try:
+                QtGui.QApplication.instance().exec_()
+            finally:
+                self.close()
+
+    def stop_capture(self):
+        """Stops sending frames to the capture in progress, if any, and closes it"""
+        if self.capture is None:
+            return
+        # the acquisition thread calls the sinks while holding its lock
+        with self.acquirer.lock:
+            self.acquirer.sinks.remove(self.capture.write)
+        self.capture.close()
+        print("Capture saved as {}".format(self.capture.path))
+        self.capture = None
+
+    def close(self):
+        """Closes any capture in progress and stops acquisition and matching"""
+        self.stop_capture()
+        if self.acquirer.is_alive():
+            self.acquirer.stop()
+        if self.match_pool is not None:
+            self.match_pool.shutdown(wait=False)
+            self.match_pool = None
 
 
 class KeyPressWindow(pg.GraphicsWindow):
@@ -286,5 +474,8 @@ class KeyPressWindow(pg.GraphicsWindow):
 
 if __name__ == "__main__":
     # log.basicConfig(level=log.DEBUG)
-    audio_app = SpectrumGUI()
+    if len(sys.argv) > 1:
+        audio_app = SpectrumGUI(sys.argv[1])
+    else:
+        audio_app = SpectrumGUI()
     audio_app.animation()
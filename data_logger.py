@@ -1,58 +1,230 @@
 import scipy.signal as sp
 import numpy as np
-import glob
-from skimage.measure import compare_ssim
+import os
+import time
+from dsp import get_plan, nearest_note, NOTE_FREQS
+from stats import STATS, lazy_import
+from fingerprint import FingerprintIndex
+from record_store import RecordStore, record_key
+from matching import StreamMatcher
+
+
+class SpectrogramBuffer:
+    """
+    Circular buffer of spectrogram rows with O(1) row insertion.
+
+    Every row is stored twice, half a buffer apart, so that the rows ordered
+    newest first are always a contiguous slice and can be returned as a view
+    without copying.
+
+    Parameters
+    ----------
+    rows : int
+        Number of rows of history held.
+    cols : int
+        Number of frequency bins in a row.
+
+    Public Methods
+    --------------
+    push(self, row):
+        Inserts a new row, discarding the oldest.
+
+    push_many(self, rows):
+        Inserts several rows, oldest first, in one step.
+
+    view(self):
+        Returns the rows ordered newest first.
+
+    reset(self):
+        Clears the history.
+    """
+
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self._data = np.zeros((2*rows, cols))
+        self._index = 0  # row holding the newest entry
+        return
+
+    @property
+    def shape(self):
+        return self.rows, self.cols
+
+    def reset(self):
+        """Clears the history"""
+        self._data.fill(0)
+        self._index = 0
+
+    def push(self, row):
+        """Inserts a new row, discarding the oldest"""
+        self._index = (self._index - 1) % self.rows
+        self._data[self._index] = row
+        self._data[self._index + self.rows] = row
+
+    def push_many(self, rows):
+        """Inserts an array of rows, ordered oldest first, in one step"""
+        rows = rows[-self.rows:]
+        self._index = (self._index - len(rows)) % self.rows
+        index = (self._index + np.arange(len(rows))) % self.rows
+        self._data[index] = rows[::-1]
+        self._data[index + self.rows] = rows[::-1]
+
+    def view(self):
+        """
+        Returns the rows ordered newest first. This is a view onto the buffer,
+        so it changes as rows are pushed; copy it if it must be kept.
+        """
+        return self._data[self._index:self._index + self.rows]
 
 
 class DataLogger:
-    def __init__(self, frame_len, sample_freq):
+    def __init__(self, frame_len, sample_freq, zero_phase=False, spec_size=100,
+                 record_dir="./record_files", hop=None):
         self.frame_len = frame_len
         self.sample_freq = sample_freq
-        self.spec_size = 100
+        self.spec_size = spec_size
 
-        self.specgram = np.zeros((self.spec_size, int(self.frame_len/2+1)))
+        # samples between overlapping STFT rows, None for one unwindowed row per frame
+        self.hop = None
+        self.history = np.zeros(0)  # filtered samples not yet past a row start
+
+        self.specgram = None
+        self.reset_specgram()
 
         self.freq_lo = 150
         self.freq_hi = 2500
 
-        # middle octave for tuning
-        self.NOTES = np.array([440, 493.88, 523.25, 587.33, 659.25, 698.46, 783.99, 880])
-
         # counter to keep track of recording
         self.record_counter = 0
 
-        # setup digital filters
+        # recordings, and fingerprints used to shortlist them before comparing in full
+        # both are opened on first use, so tuning alone never reads them
+        self.record_dir = record_dir
+        self._records = None
+        self._fingerprints = None
+        self.match_candidates = 5
+        self.match_job = None  # background match started by audio_match
+        self.listener = None  # streaming matcher used by listen
+
+        # setup digital filters, either streamed with their state carried
+        # between frames or applied forward-backward to each frame in isolation
+        self.zero_phase = zero_phase
+        self.reset_filters()
         self.set_filters()
+        self.set_hop(hop)
 
         return
 
+    @property
+    def records(self):
+        if self._records is None:
+            self._records = RecordStore(os.path.join(self.record_dir, "records.spec"))
+        return self._records
+
+    @property
+    def fingerprints(self):
+        if self._fingerprints is None:
+            self._fingerprints = FingerprintIndex(os.path.join(self.record_dir,
+                                                               "fingerprints.json"))
+        return self._fingerprints
+
     def get_specgram(self):
-        return self.specgram
+        """Returns the spectrogram, newest row first, as a view onto its buffer"""
+        return self.specgram.view()
+
+    def reset_specgram(self):
+        """Clears the spectrogram, only reallocating it if its shape has changed"""
+        self.listener = None
+        shape = (self.spec_size, int(self.frame_len/2+1))
+        if self.specgram is not None and self.specgram.shape == shape:
+            self.specgram.reset()
+        else:
+            self.specgram = SpectrogramBuffer(*shape)
+
+    def set_spec_size(self, spec_size):
+        """Sets the number of rows of spectrogram history"""
+        self.spec_size = spec_size
+        self.record_counter = 0
+        self.reset_specgram()
 
     def set_filters(self):
-        fn_lo = self.freq_lo/self.sample_freq
-        fn_hi = self.freq_hi/self.sample_freq
+        """
+        Loads the cached DSP plan for the current configuration. Any streaming
+        state is kept so that a cutoff change does not restart the filters
+        mid-stream.
+        """
+        self.plan = get_plan(self.sample_freq, self.frame_len, self.freq_lo, self.freq_hi)
+        self.sos_lo = self.plan.sos_lo
+        self.sos_hi = self.plan.sos_hi
+        self.freq_bins = self.plan.freq_bins
+        self.time_bins = self.plan.time_bins
+
+    def reset_filters(self):
+        """Clears the streaming filter state, e.g. when the input stream restarts"""
+        self.zi_lo = None
+        self.zi_hi = None
+        self.history = np.zeros(0)
+
+    def set_hop(self, hop):
+        """
+        Sets the number of samples between spectrogram rows. A hop shorter than
+        the frame length gives overlapping, Hann windowed rows computed over the
+        sample history, so the spectrogram and peak update several times per
+        frame. None gives one unwindowed row per frame.
+        """
+        if hop is not None and not 0 < hop <= self.frame_len:
+            raise ValueError("Hop must be between 1 and the frame length {}".format(self.frame_len))
+        self.hop = hop
+        self.history = np.zeros(0)
+        self.record_counter = 0
+        # recordings are only matched against rows taken with the same hop
+        self.listener = None
 
-        self.blo, self.alo = sp.butter(4, fn_lo*2, btype='highpass')
-        try:
-            self.b, self.a = sp.butter(2, fn_hi*2)
-        except ValueError:
-            pass
+    def filter(self, wf_data):
+        """
+        High pass, and if the sampling frequency allows low pass, filters a frame
+        or an (n_frames, frame_len) array of consecutive frames.
+        """
+        low_pass = self.sos_hi is not None
+        if self.zero_phase:
+            wf_data = sp.sosfiltfilt(self.sos_lo, wf_data, axis=-1)
+            if low_pass:
+                wf_data = sp.sosfiltfilt(self.sos_hi, wf_data, axis=-1)
+            return wf_data
+
+        # consecutive frames are one continuous stream to the filters
+        shape = np.shape(wf_data)
+        wf_data = np.ravel(wf_data)
+
+        # start each filter in its steady state for the first sample
+        if self.zi_lo is None:
+            self.zi_lo = sp.sosfilt_zi(self.sos_lo)*wf_data[0]
+        wf_data, self.zi_lo = sp.sosfilt(self.sos_lo, wf_data, zi=self.zi_lo)
+
+        if low_pass:
+            if self.zi_hi is None:
+                self.zi_hi = sp.sosfilt_zi(self.sos_hi)*wf_data[0]
+            wf_data, self.zi_hi = sp.sosfilt(self.sos_hi, wf_data, zi=self.zi_hi)
+        else:
+            self.zi_hi = None
+        return wf_data.reshape(shape)
 
     def get_data_axis(self):
-        self.freq_bins = np.fft.rfftfreq(self.frame_len, 1/self.sample_freq)
-        self.time_bins = np.linspace(0, self.frame_len/self.sample_freq, self.frame_len)
         return self.freq_bins, self.time_bins
 
     def set_sample_freq(self, freq):
         self.sample_freq = freq
+        self.reset_filters()
         self.set_filters()
-        self.specgram = np.zeros((self.spec_size, int(self.frame_len/2+1)))
+        self.reset_specgram()
         return self.get_data_axis()
 
     def set_frame_len(self, frame_len):
         self.frame_len = frame_len
-        self.specgram = np.zeros((self.spec_size, int(self.frame_len/2+1)))
+        self.set_filters()
+        self.reset_specgram()
+        if self.hop is not None:
+            self.set_hop(min(self.hop, frame_len))
         return self.get_data_axis()
 
     def set_low_cutoff(self, freq):
@@ -66,22 +238,85 @@ class DataLogger:
         return
 
     def process(self, wf_data):
-        # high pass filter
-        wf_data = sp.filtfilt(self.blo, self.alo, wf_data)
+        sp_data, psd, freq_peak, wf_data = self.process_batch(np.atleast_2d(wf_data))
+        return sp_data[-1], wf_data[-1]
+
+    def process_batch(self, frames):
+        """
+        Processes an (n_frames, frame_len) array of consecutive frames in a single
+        vectorised pass, adding a spectrogram row for every frame, or every hop
+        samples if a hop is set.
 
-        # if sampling frequency allows, low pass filter to reduce quantisation
-        if self.freq_hi < self.sample_freq/2:
-            wf_data = sp.filtfilt(self.b, self.a, wf_data)
+        Returns the spectra, power spectral densities and peak frequencies, with
+        one entry per spectrogram row, and the filtered waveforms, with one
+        entry per frame.
+        """
+        # high pass filter, and low pass filter to reduce quantisation
+        with STATS.timer("filter"):
+            wf_data = self.filter(frames)
 
-        sp_data = np.abs(np.fft.rfft(wf_data))
+        with STATS.timer("fft"):
+            if self.hop is None:
+                sp_data = np.abs(np.fft.rfft(wf_data, axis=-1))
+            else:
+                sp_data = np.abs(np.fft.rfft(self.stft_rows(wf_data)*self.plan.window, axis=-1))
 
         # get power spectral density for spectrogram
-        psd = 20 * np.log10(sp_data + np.ones(len(sp_data))*0.1)
-        self.specgram = np.roll(self.specgram, 1, 0)
-        self.specgram[0] = psd
-        self.freq_peak = self.freq_bins[np.argmax(sp_data)]
+        psd = 20 * np.log10(sp_data + 0.1)
+        self.specgram.push_many(psd)
+        freq_peak = self.peak_freqs(sp_data)
+        if len(freq_peak):
+            self.freq_peak = freq_peak[-1]
 
-        return sp_data, wf_data
+        return sp_data, psd, freq_peak, wf_data
+
+    def stft_rows(self, wf_data):
+        """
+        Adds filtered frames to the sample history and returns a strided view of
+        every complete frame_len window starting a hop after the previous one.
+        """
+        samples = np.concatenate((self.history, np.ravel(wf_data)))
+        n_rows = max((len(samples) - self.frame_len)//self.hop + 1, 0)
+        self.history = samples[n_rows*self.hop:]
+        windows = np.lib.stride_tricks.sliding_window_view(samples, self.frame_len)
+        return windows[:n_rows*self.hop:self.hop]
+
+    def frames_for_rows(self, rows):
+        """
+        Returns the fewest frames that process_batch needs to add at least rows
+        spectrogram rows, and at least one frame.
+        """
+        if self.hop is None:
+            return max(rows, 1)
+        # rows start every hop samples from the start of the sample history
+        samples = (rows - 1)*self.hop + self.frame_len - len(self.history)
+        return max(-(-samples//self.frame_len), 1)
+
+    def row_frames(self, n_rows, n_frames):
+        """
+        Returns the index, within the last batch of n_frames frames passed to
+        process_batch, of the frame each of its n_rows spectrogram rows ends in.
+        """
+        if self.hop is None:
+            return np.arange(n_rows)
+        # rows start every hop samples from the start of the history kept before the batch
+        before = len(self.history) + n_rows*self.hop - n_frames*self.frame_len
+        return (np.arange(n_rows)*self.hop + self.frame_len - 1 - before)//self.frame_len
+
+    def peak_freqs(self, sp_data):
+        """
+        Returns the peak frequency of each spectrum, refined between FFT bins by
+        fitting a parabola to the log magnitudes of the peak bin and its
+        neighbours.
+        """
+        if len(sp_data) == 0:
+            return np.zeros(0)
+        peak = np.clip(np.argmax(sp_data, axis=-1), 1, sp_data.shape[-1] - 2)
+        rows = np.arange(len(sp_data))
+        below, centre, above = (np.log(sp_data[rows, peak + i] + 1e-12) for i in (-1, 0, 1))
+        curve = below - 2*centre + above
+        offset = np.divide(below - above, 2*curve, out=np.zeros(len(rows)), where=curve < 0)
+        return (peak + np.clip(offset, -0.5, 0.5))*self.sample_freq/self.frame_len
 
     def tune(self):
         """
@@ -89,21 +324,14 @@ class DataLogger:
         """
         if self.freq_peak < self.freq_lo:
             return
-        tuning_freq = self.get_tuning_freq(self.freq_peak)
+        index_freq = nearest_note(self.freq_peak)
+        tuning_freq = NOTE_FREQS[index_freq]
 
         # create 5 bins around the closest frequency to the current peak
-        index_freq = np.argwhere(self.NOTES == tuning_freq)[0][0]
         bands = np.zeros(5)
         bands[2] = tuning_freq
-        if index_freq == 0:
-            bands[0] = (tuning_freq + self.NOTES[-1]/2)/2
-        else:
-            bands[0] = (tuning_freq + self.NOTES[index_freq-1])/2
-
-        if index_freq == len(self.NOTES)-1:
-            bands[4] = (tuning_freq + self.NOTES[0]*2)/2
-        else:
-            bands[4] = (tuning_freq + self.NOTES[index_freq+1])/2
+        bands[0] = (tuning_freq + NOTE_FREQS[max(index_freq - 1, 0)])/2
+        bands[4] = (tuning_freq + NOTE_FREQS[min(index_freq + 1, len(NOTE_FREQS) - 1)])/2
 
         bands[1] = (bands[0] + bands[2])/2
         bands[3] = (bands[4] + bands[2])/2
@@ -114,76 +342,135 @@ class DataLogger:
         return self.freq_peak, tuning_freq, LED
 
     def get_tuning_freq(self, freq):
-        """Returns the not the current maxe frequency is closest to"""
+        """Returns the natural note the given frequency is closest to"""
         if freq < self.freq_lo:
             return
-
-        while freq < self.NOTES.min() or freq > self.NOTES.max():
-            while freq > self.NOTES.max():
-                self.NOTES *= 2
-            while freq < self.NOTES.min():
-                self.NOTES /= 2
-        tuning_freq = min(self.NOTES, key=lambda x: abs(x-freq))
-        return tuning_freq
+        return NOTE_FREQS[nearest_note(freq)]
 
     def record(self, file_name):
         self.record_counter += 1
         if self.record_counter > self.spec_size:
-            fullname = "{}_{}_{}_{}.npy".format(file_name, self.sample_freq,
-                                                self.frame_len, self.spec_size)
-            np.save("./record_files/"+fullname, self.specgram)
-            print("Record saved as {}".format(fullname))
+            key = self.save_record(file_name, self.get_specgram())
+            print("Record saved as {}".format(key))
             self.record_counter = 0
             return True
         else:
             return False
 
-    def audio_match(self, cmp_file=None, new_file=None):
+    def save_record(self, name, specgram):
+        """Adds a spectrogram to the recording store and fingerprint index"""
+        key = self.records.append(name, specgram, self.sample_freq, self.frame_len,
+                                  self.spec_size, self.hop or 0)
+        self.fingerprints.add(key, specgram)
+        return key
+
+    def audio_match(self, cmp_file=None, new_file=None, pool=None):
+        """
+        Compares the spectrogram to the recordings once it has filled. When no
+        comparison file is given it is matched against the whole library, in the
+        background if a MatchPool is supplied, in which case poll_match must be
+        called to collect the result.
+        """
         self.record_counter += 1
         if self.record_counter > self.spec_size:
             if cmp_file is None:
-                footer = "_{}_{}_{}.npy".format(self.sample_freq, self.frame_len,
-                                                self.spec_size)
-
-                files = glob.glob("./record_files/*{}".format(footer))
-                match = ''
-                mssim_best = -10
-                for file in files:
-                    record = np.load(file)
-                    mssim = compare_ssim(record, self.specgram, win_size=51)
-                    if mssim > mssim_best:
-                        match = file
-                        mssim_best = mssim
-                    print("MSSIM of compared to {}: {}".format(file, mssim))
-
-                file_name = match
-                match = match.replace(footer, '')
-                match = match.replace("./record_files/", '')
-                print("Best estimate: {}".format(match))
-                match_split = match.split('_')
-                if match_split[-1].isdigit():
-                    match = match.replace(match_split[-1], '')
-
-                files = glob.glob("./record_files/{}*".format(match))
-                match += str(len(files)+1) + footer
-                np.save("./record_files/"+match, self.specgram)
-                print("Record saved as {}".format(match))
+                if pool is None:
+                    self.save_match(self.get_specgram(), self.score_matches())
+                else:
+                    self.cancel_match()
+                    self.match_job = pool.submit(self.get_specgram(), self.candidate_keys(),
+                                                 self.records.path)
 
             else:
-                record_fullname = "{}_{}_{}_{}.npy".format(cmp_file, self.sample_freq,
-                                                           self.frame_len, self.spec_size)
-                record = np.load("./record_files/"+record_fullname)
+                record = self.records.get(record_key(cmp_file, self.sample_freq,
+                                                     self.frame_len, self.spec_size,
+                                                     self.hop or 0))
 
-                mssim = compare_ssim(record, self.specgram, win_size=51)
+                compare_ssim = lazy_import("skimage.measure").compare_ssim
+                mssim = compare_ssim(record, self.get_specgram(), win_size=51)
                 print("MSSIM of new recording: {}".format(mssim))
 
                 if new_file is not None:
-                    record_fullname = "{}_{}_{}.npy".format(new_file, self.sample_freq,
-                                                            self.frame_len, self.spec_size)
-                    np.save("./record_files"+record_fullname, self.specgram)
-                    print("Comparison saved as {}".format(record_fullname))
+                    key = self.save_record(new_file, self.get_specgram())
+                    print("Comparison saved as {}".format(key))
 
             self.record_counter = 0
             return True
         else:
             return False
+
+    def candidate_keys(self):
+        """Returns the recordings with the current configuration worth comparing in full"""
+        keys = self.records.find(sample_freq=self.sample_freq, frame_len=self.frame_len,
+                                 spec_size=self.spec_size, hop=self.hop or 0)
+        return self.fingerprints.shortlist(self.get_specgram(), keys, self.records.get,
+                                           self.match_candidates)
+
+    def score_matches(self):
+        """Returns the MSSIM of the spectrogram compared to each candidate recording"""
+        scores = dict()
+        compare_ssim = lazy_import("skimage.measure").compare_ssim
+        with STATS.timer("match"):
+            for key in self.candidate_keys():
+                record = self.records.get(key)
+                scores[key] = compare_ssim(record, self.get_specgram(), win_size=51)
+        return scores
+
+    def save_match(self, specgram, scores):
+        """Reports the best scoring recording and saves specgram as a new take of it"""
+        match = ''
+        mssim_best = -10
+        for key, mssim in scores.items():
+            if mssim > mssim_best:
+                match = self.records.entries[key]["name"]
+                mssim_best = mssim
+            print("MSSIM of compared to {}: {}".format(key, mssim))
+
+        print("Best estimate: {}".format(match))
+        match_split = match.split('_')
+        if match_split[-1].isdigit():
+            match = match.replace(match_split[-1], '')
+
+        takes = [key for key in self.records.entries if key.startswith(match)]
+        key = self.save_record(match + str(len(takes)+1), specgram)
+        print("Record saved as {}".format(key))
+        return
+
+    def poll_match(self):
+        """
+        Saves the result of a background match once it has finished. Returns True
+        if a match finished.
+        """
+        if self.match_job is None or not self.match_job.done():
+            return False
+        job, self.match_job = self.match_job, None
+        STATS.add("match", time.perf_counter() - job.started)
+        self.save_match(job.specgram, job.results())
+        return True
+
+    def listen(self, rows):
+        """
+        Matches spectrogram rows, oldest first, against the recordings with the
+        current configuration as they arrive. Returns the name of the recording
+        once it is confidently ahead of the rest, otherwise None.
+        """
+        if self.listener is None:
+            keys = self.records.find(sample_freq=self.sample_freq, frame_len=self.frame_len,
+                                     hop=self.hop or 0)
+            self.listener = StreamMatcher(self.records, keys)
+        with STATS.timer("listen"):
+            for row in rows:
+                key = self.listener.update(row)
+                if key is not None:
+                    print("Best estimate: {} after {} rows".format(
+                        self.records.entries[key]["name"], self.listener.rows))
+                    self.listener.reset()
+                    return self.records.entries[key]["name"]
+        return
+
+    def cancel_match(self):
+        """Abandons any background match that is still running"""
+        if self.match_job is not None:
+            self.match_job.cancel()
+            self.match_job = None
+        return
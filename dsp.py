@@ -0,0 +1,109 @@
+import collections
+import functools
+import numpy as np
+import scipy.signal as sp
+
+DSPPlan = collections.namedtuple("DSPPlan", ["sample_freq", "frame_len", "freq_lo", "freq_hi",
+                                             "sos_lo", "sos_hi", "freq_bins", "time_bins",
+                                             "window"])
+DSPPlan.__doc__ = """
+Immutable set of everything DataLogger precomputes for one configuration.
+
+Attributes
+----------
+sample_freq : int
+    Sampling Frequency.
+frame_len : int
+    Number of samples in a frame.
+freq_lo : float
+    High pass cutoff frequency.
+freq_hi : float
+    Low pass cutoff frequency.
+sos_lo : np.ndarray
+    Second order sections of the high pass filter.
+sos_hi : np.ndarray
+    Second order sections of the low pass filter, None if the cutoff is above
+    the Nyquist frequency.
+freq_bins : np.ndarray
+    Frequency of each FFT bin.
+time_bins : np.ndarray
+    Time of each sample in a frame.
+window : np.ndarray
+    Periodic Hann window for overlapping STFT rows, normalised to unit mean so
+    that a windowed tone peaks at the same magnitude as an unwindowed one.
+"""
+
+
+def _frozen(array):
+    array.setflags(write=False)
+    return array
+
+
+# natural notes A, B, C, D, E, F and G as semitones above A
+NATURAL_SEMITONES = (0, 2, 3, 5, 7, 8, 10)
+NOTE_LO = 27.5  # A0
+NOTE_OCTAVES = 9
+
+
+def _note_table():
+    semitones = np.add.outer(12*np.arange(NOTE_OCTAVES), NATURAL_SEMITONES).ravel()
+    semitones = np.append(semitones, 12*NOTE_OCTAVES)
+    # nearest note, in log frequency, to every cent across the table's range
+    cents = np.arange(1200*NOTE_OCTAVES + 1)
+    edges = (semitones[:-1] + semitones[1:])*50
+    return _frozen(NOTE_LO*2**(semitones/12)), _frozen(np.searchsorted(edges, cents))
+
+
+# frequency of every natural note from A0 to A9, and index of the nearest one for each cent
+NOTE_FREQS, _NEAREST_NOTE = _note_table()
+
+
+def nearest_note(freq):
+    """
+    Returns the index in NOTE_FREQS of the natural note closest to freq, in
+    log frequency, for a frequency or an array of frequencies. The lookup is a
+    single table index per frequency.
+    """
+    cents = np.rint(1200*np.log2(np.maximum(freq, NOTE_LO)/NOTE_LO))
+    return _NEAREST_NOTE[np.minimum(cents, len(_NEAREST_NOTE) - 1).astype(np.intp)]
+
+
+# configurations the firmware supports
+BOARD_SAMPLE_FREQS = (4000, 7000, 9000)
+BOARD_FRAME_LENS = (256, 512, 800, 1024)
+
+
+@functools.lru_cache(maxsize=32)
+def get_plan(sample_freq, frame_len, freq_lo, freq_hi):
+    """
+    Returns the DSPPlan for a configuration, designing it on first use and
+    serving it from a small LRU cache afterwards so that switching between
+    configurations does not redesign the filters.
+    """
+    fn_lo = freq_lo/sample_freq
+    fn_hi = freq_hi/sample_freq
+
+    # scipy's sosfilt needs writable coefficients, so these are left unfrozen
+    sos_lo = sp.butter(4, fn_lo*2, btype='highpass', output='sos')
+    if fn_hi < 0.5:
+        sos_hi = sp.butter(2, fn_hi*2, output='sos')
+    else:
+        sos_hi = None
+
+    freq_bins = _frozen(np.fft.rfftfreq(frame_len, 1/sample_freq))
+    time_bins = _frozen(np.linspace(0, frame_len/sample_freq, frame_len))
+    window = sp.get_window("hann", frame_len)
+    window = _frozen(window/window.mean())
+    return DSPPlan(sample_freq, frame_len, freq_lo, freq_hi, sos_lo, sos_hi, freq_bins, time_bins,
+                   window)
+
+
+def warm_plans(freq_lo, freq_hi, sample_freqs=BOARD_SAMPLE_FREQS, frame_lens=BOARD_FRAME_LENS):
+    """
+    Designs the plan for every configuration the board supports, e.g. from a
+    background thread at startup, so later configuration changes hit the cache.
+    """
+    for sample_freq in sample_freqs:
+        for frame_len in frame_lens:
+            get_plan(sample_freq, frame_len, freq_lo, freq_hi)
+    return
@@ -0,0 +1,88 @@
+import os
+import json
+import numpy as np
+from stats import lazy_import
+
+# dB range mapped onto the fingerprint image, matching the spectrogram display
+DB_MIN = 20
+DB_MAX = 80
+
+
+def fingerprint(specgram, hash_size=16):
+    """Returns a perceptual hash of a dB spectrogram"""
+    img = np.clip((specgram - DB_MIN)*255/(DB_MAX - DB_MIN), 0, 255)
+    image = lazy_import("PIL.Image").fromarray(img.astype(np.uint8))
+    return lazy_import("imagehash").phash(image, hash_size=hash_size)
+
+
+class FingerprintIndex:
+    """
+    Persistent index of compact perceptual fingerprints of the recordings, used
+    to shortlist candidates before running the full SSIM comparison.
+
+    Parameters
+    ----------
+    path : str
+        JSON file the index is stored in.
+
+    Attributes
+    ----------
+    hashes : dict
+        Hex encoded fingerprint of each recording, keyed by its record key.
+
+    Public Methods
+    --------------
+    add(self, key, specgram):
+        Fingerprints a recording and saves the index.
+
+    get(self, key, load):
+        Returns the fingerprint of a recording, fingerprinting it if needed.
+
+    shortlist(self, specgram, keys, load, k):
+        Returns the k recordings whose fingerprints are closest to specgram.
+    """
+
+    def __init__(self, path="./record_files/fingerprints.json"):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.hashes = json.load(f)
+        except (IOError, ValueError):
+            self.hashes = dict()
+        return
+
+    def save(self):
+        """Writes the index to disk, replacing the old copy atomically"""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.hashes, f)
+        os.replace(tmp, self.path)
+
+    def add(self, key, specgram, save=True):
+        """Fingerprints a recording and adds it to the index"""
+        self.hashes[key] = str(fingerprint(specgram))
+        if save:
+            self.save()
+
+    def get(self, key, load):
+        """
+        Returns the fingerprint of a recording, using load(key) to fetch and
+        index its spectrogram if it is missing.
+        """
+        if key not in self.hashes:
+            self.add(key, load(key), save=False)
+        return lazy_import("imagehash").hex_to_hash(self.hashes[key])
+
+    def shortlist(self, specgram, keys, load, k=5):
+        """Returns the k recordings whose fingerprints are closest to the spectrogram"""
+        if len(keys) <= k:
+            return list(keys)
+
+        size = len(self.hashes)
+        target = fingerprint(specgram).hash.ravel()
+        hashes = np.array([self.get(key, load).hash.ravel() for key in keys])
+        if len(self.hashes) != size:
+            self.save()
+
+        distance = np.count_nonzero(hashes != target, axis=1)
+        return [keys[i] for i in np.argsort(distance, kind='stable')[:k]]
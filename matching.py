@@ -0,0 +1,238 @@
+import os
+import time
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from record_store import RecordStore
+from stats import lazy_import
+
+# recording stores opened by this worker process, keyed by path
+_stores = dict()
+
+
+def _load(path, key):
+    # stores are opened lazily and memory mapped, so recordings are only read
+    # from the page cache as they are scored. A recording appended under an
+    # existing key replaces it, so the index is refreshed on every load; this
+    # only reads the header unless the store has changed
+    if path not in _stores:
+        _stores[path] = RecordStore(path)
+    store = _stores[path]
+    store.refresh()
+    return store.get(key)
+
+
+def score(keys, specgram, path):
+    """Returns the MSSIM of each recording in the store compared to the spectrogram"""
+    compare_ssim = lazy_import("skimage.measure").compare_ssim
+    return [(key, compare_ssim(_load(path, key), specgram, win_size=51)) for key in keys]
+
+
+class MatchJob:
+    """
+    Handle on a set of candidate recordings being scored by a MatchPool.
+
+    Attributes
+    ----------
+    specgram : np.ndarray
+        Copy of the spectrogram being matched.
+    started : float
+        time.perf_counter() when the job was submitted.
+
+    Public Methods
+    --------------
+    done(self):
+        Returns True once every candidate has been scored or cancelled.
+
+    results(self):
+        Returns the MSSIM of each candidate scored so far.
+
+    cancel(self):
+        Cancels the candidates that have not started scoring.
+    """
+
+    def __init__(self, futures, specgram):
+        self.futures = futures
+        self.specgram = specgram
+        self.started = time.perf_counter()
+        return
+
+    def done(self):
+        """Returns True once every candidate has been scored or cancelled"""
+        return all(future.done() for future in self.futures)
+
+    def results(self):
+        """Returns a dict of the MSSIM of each candidate scored so far"""
+        scores = dict()
+        for future in self.futures:
+            if future.done() and not future.cancelled():
+                scores.update(future.result())
+        return scores
+
+    def cancel(self):
+        """Cancels the candidates that have not started scoring"""
+        for future in self.futures:
+            future.cancel()
+        return
+
+
+class MatchPool:
+    """
+    Pool of worker processes that score candidate recordings against a
+    spectrogram in the background.
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes, defaults to the number of cores.
+
+    Public Methods
+    --------------
+    submit(self, specgram, keys, path):
+        Starts scoring recordings against the spectrogram and returns a MatchJob.
+
+    shutdown(self):
+        Cancels pending work and stops the worker processes.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count()
+        # the pool is started once acquisition threads are running, and a forked
+        # worker could inherit a lock one of them holds, e.g. STATS._lock
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.executor = ProcessPoolExecutor(max_workers=self.workers,
+                                            mp_context=multiprocessing.get_context(method))
+        return
+
+    def submit(self, specgram, keys, path):
+        """
+        Starts scoring the recordings stored under keys in the store at path
+        against the spectrogram and returns a MatchJob.
+        """
+        specgram = np.array(specgram)
+        # a couple of chunks per worker, so a cancelled job frees the pool quickly
+        chunks = np.array_split(np.asarray(keys, dtype=object),
+                                min(len(keys), 2*self.workers) or 1)
+        futures = [self.executor.submit(score, list(chunk), specgram, path)
+                   for chunk in chunks if len(chunk)]
+        return MatchJob(futures, specgram)
+
+    def shutdown(self, wait=True):
+        """Cancels pending work and stops the worker processes"""
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+        return
+
+
+def _normalise(rows):
+    # zero mean, unit norm rows, so that a dot product is a correlation
+    rows = rows - rows.mean(axis=-1, keepdims=True)
+    norm = np.linalg.norm(rows, axis=-1, keepdims=True)
+    return rows/np.where(norm > 0, norm, 1)
+
+
+class StreamMatcher:
+    """
+    Matches a live spectrogram against the recordings one row at a time, so a
+    recording can be recognised as soon as it is clearly ahead rather than once
+    a whole spectrogram has been compared.
+
+    The recordings are stacked into one array of normalised rows. Each new row
+    is correlated with every recorded row in a single matrix product, and the
+    correlations are accumulated along each diagonal, i.e. for every alignment
+    of the live stream against each recording, as an exponentially decaying
+    average. The cost per row is constant however long the stream runs.
+
+    Parameters
+    ----------
+    store : RecordStore()
+        Store holding the recordings.
+    keys : list of str
+        Recordings to match against, all with the same number of bands.
+    decay : float
+        Weight of the previous average each row, 0.9 averages over about 10 rows.
+    min_rows : int
+        Rows an alignment must have been followed for before it is scored.
+    margin : float
+        Lead in correlation the best recording needs over the next to be
+        reported.
+    threshold : float
+        Correlation the best recording needs to be reported.
+
+    Attributes
+    ----------
+    rows : int
+        Number of rows matched since the last reset.
+    best : str
+        Key of the recording identified, None until one is confidently ahead.
+
+    Public Methods
+    --------------
+    update(self, row):
+        Adds a spectrogram row, returning the key of the recording once identified.
+
+    scores(self):
+        Returns the current score of each recording.
+
+    reset(self):
+        Clears the scores, e.g. when the input changes.
+    """
+
+    def __init__(self, store, keys, decay=0.9, min_rows=10, margin=0.1, threshold=0.5):
+        self.keys = list(keys)
+        self.decay = decay
+        self.min_rows = min_rows
+        self.margin = margin
+        self.threshold = threshold
+
+        # recordings are stored newest row first
+        records = [store.get(key)[::-1] for key in self.keys]
+        length = max([len(record) for record in records] or [0])
+        bands = records[0].shape[1] if records else 0
+        self.library = np.zeros((len(records), length, bands), dtype=np.float32)
+        for i, record in enumerate(records):
+            self.library[i, :len(record)] = _normalise(record)
+        self.reset()
+        return
+
+    def reset(self):
+        """Clears the scores, e.g. when the input changes"""
+        length = self.library.shape[1]
+        self._average = np.zeros((len(self.keys), length))
+        self._weight = np.zeros(length)
+        self._run = np.zeros(length, dtype=int)
+        self.rows = 0
+        self.best = None
+        return
+
+    def update(self, row):
+        """
+        Adds a spectrogram row, returning the key of the recording once it is
+        confidently ahead of the rest, otherwise None.
+        """
+        if self.best is not None or not self.keys:
+            return self.best
+        corr = self.library @ _normalise(np.asarray(row, dtype=np.float32))
+
+        # shift every alignment on by a recorded row, starting a new one at row 0
+        self._average[:, 1:] = self.decay*self._average[:, :-1]
+        self._average[:, 0] = 0
+        self._average += (1 - self.decay)*corr
+        self._weight[1:] = self.decay*self._weight[:-1] + (1 - self.decay)
+        self._weight[0] = 1 - self.decay
+        self._run[1:] = self._run[:-1] + 1
+        self._run[0] = 1
+        self.rows += 1
+
+        scores = sorted(self.scores().values(), reverse=True) + [-1.]
+        if scores[0] >= self.threshold and scores[0] - scores[1] >= self.margin:
+            scores = self.scores()
+            self.best = max(scores, key=scores.get)
+        return self.best
+
+    def scores(self):
+        """Returns the best alignment's average correlation for each recording"""
+        valid = self._run >= self.min_rows
+        if not valid.any():
+            return dict()
+        best = (self._average[:, valid]/self._weight[valid]).max(axis=1)
+        return dict(zip(self.keys, best.tolist()))
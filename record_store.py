@@ -0,0 +1,269 @@
+import os
+import glob
+import argparse
+import json
+import struct
+import numpy as np
+
+MAGIC = b"SPECREC1"
+# magic, number of records, index offset, index length
+HEADER = struct.Struct("<8sIQQ")
+HEADER_SIZE = 64
+ALIGN = 64
+
+
+def record_key(name, sample_freq, frame_len, spec_size, hop=0):
+    """
+    Returns the key a recording is stored under, as its old .npy file name stem,
+    followed by the hop if its rows overlap.
+    """
+    key = "{}_{}_{}_{}".format(name, sample_freq, frame_len, spec_size)
+    if hop:
+        key += "_h{}".format(hop)
+    return key
+
+
+def quantize(specgram, dtype=np.uint8, decimate=1):
+    """
+    Returns a dB spectrogram averaged over groups of decimate frequency bands
+    and converted to dtype, with the scale and offset that map it back to dB.
+    uint8 spans the spectrogram's own range, which for 20*log10 magnitudes is
+    a step of about half a dB.
+    """
+    specgram = np.asarray(specgram, dtype=float)
+    if decimate > 1:
+        pad = -specgram.shape[1] % decimate
+        specgram = np.pad(specgram, ((0, 0), (0, pad)), mode="edge")
+        specgram = specgram.reshape(len(specgram), -1, decimate).mean(axis=2)
+
+    dtype = np.dtype(dtype)
+    if dtype != np.uint8:
+        return specgram.astype(dtype), 1., 0.
+    offset = float(specgram.min())
+    scale = float(specgram.max() - offset)/255 or 1.
+    return np.rint((specgram - offset)/scale).astype(np.uint8), scale, offset
+
+
+def dequantize(data, scale, offset, decimate=1, bands=None):
+    """Returns the float64 dB spectrogram of quantize() output at its full number of bands"""
+    specgram = data*scale + offset
+    if decimate > 1:
+        specgram = np.repeat(specgram, decimate, axis=1)[:, :bands]
+    return specgram
+
+
+class RecordStore:
+    """
+    Append-only, memory-mapped container holding every recorded spectrogram in
+    a single file.
+
+    The file starts with a fixed size header pointing at a JSON index of the
+    records. Appending writes the new spectrogram and a new index after the
+    existing data and only then updates the header, so readers always see a
+    complete index. Spectrograms are returned as read-only views onto the
+    memory map, so they are loaded lazily from the page cache. Only one
+    process should append to a store at a time.
+
+    Each record keeps the hop between its spectrogram rows, 0 for one
+    unwindowed row per frame, as rows taken with different hops have different
+    time scales and cannot be compared.
+
+    Spectrograms are stored quantized, by default to uint8 with a per record
+    scale and offset, and optionally averaged over groups of frequency bands.
+    get() restores them to float64 dB at full width, so readers do not depend
+    on how a record was stored. Records of any dtype may share a store.
+
+    Parameters
+    ----------
+    path : str
+        File the store is kept in. It is created on the first append.
+    dtype : np.dtype
+        Type new spectrograms are stored as, uint8, float16 or float64.
+    decimate : int
+        Number of adjacent frequency bands averaged into each stored band.
+
+    Attributes
+    ----------
+    entries : dict
+        Metadata of each record, keyed by record_key().
+
+    Public Methods
+    --------------
+    refresh(self):
+        Re-reads the index if the store has been appended to.
+
+    find(self, name=None, sample_freq=None, frame_len=None, spec_size=None, hop=None):
+        Returns the keys of the records matching all of the given fields.
+
+    get(self, key):
+        Returns the spectrogram stored under key, as float64 dB.
+
+    get_stored(self, key):
+        Returns a read-only view of the spectrogram as it is stored.
+
+    append(self, name, specgram, sample_freq, frame_len, spec_size, hop=0):
+        Adds a spectrogram to the store, replacing any with the same key.
+
+    append_many(self, records):
+        Adds several spectrograms to the store, writing the index once.
+
+    import_npy(self, directory):
+        Imports recordings saved as individual .npy files.
+    """
+
+    def __init__(self, path="./record_files/records.spec", dtype=np.uint8, decimate=1):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.decimate = decimate
+        self.entries = dict()
+        self._by_config = dict()
+        self._index_offset = None
+        self._mmap = None
+        self.refresh()
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def _read_header(self, f):
+        magic, count, index_offset, index_len = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError("{} is not a recording store".format(self.path))
+        return count, index_offset, index_len
+
+    def refresh(self):
+        """Re-reads the index if the store has been appended to since it was opened"""
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return
+        with f:
+            count, index_offset, index_len = self._read_header(f)
+            if index_offset == self._index_offset:
+                return
+            f.seek(index_offset)
+            index = json.loads(f.read(index_len).decode("utf-8"))
+
+        self._mmap = np.memmap(self.path, dtype=np.uint8, mode="r")
+        self._index_offset = index_offset
+        self.entries = dict((entry["key"], entry) for entry in index)
+        self._by_config = dict()
+        for key, entry in self.entries.items():
+            # stores written before hops were recorded only hold unwindowed rows
+            entry.setdefault("hop", 0)
+            config = (entry["sample_freq"], entry["frame_len"], entry["spec_size"], entry["hop"])
+            self._by_config.setdefault(config, []).append(key)
+        return
+
+    def find(self, name=None, sample_freq=None, frame_len=None, spec_size=None, hop=None):
+        """Returns the keys of the records matching all of the given fields"""
+        if None not in (sample_freq, frame_len, spec_size, hop):
+            keys = self._by_config.get((sample_freq, frame_len, spec_size, hop), [])
+        else:
+            keys = self.entries.keys()
+        fields = dict(name=name, sample_freq=sample_freq, frame_len=frame_len,
+                      spec_size=spec_size, hop=hop)
+        fields = dict((k, v) for k, v in fields.items() if v is not None)
+        return [key for key in keys
+                if all(self.entries[key][k] == v for k, v in fields.items())]
+
+    def get(self, key):
+        """
+        Returns the spectrogram stored under key as float64 dB. Records stored
+        unquantized are returned as a read-only view onto the store.
+        """
+        entry = self.entries[key]
+        data = self.get_stored(key)
+        if "scale" not in entry:
+            return data
+        return dequantize(data, entry["scale"], entry["db_offset"], entry["decimate"],
+                          entry["bands"])
+
+    def get_stored(self, key):
+        """Returns a read-only view of the spectrogram stored under key, as stored"""
+        entry = self.entries[key]
+        dtype = np.dtype(entry["dtype"])
+        size = int(np.prod(entry["shape"]))*dtype.itemsize
+        data = self._mmap[entry["offset"]:entry["offset"] + size]
+        return np.ndarray(entry["shape"], dtype, buffer=data)
+
+    def append(self, name, specgram, sample_freq, frame_len, spec_size, hop=0):
+        """Adds a spectrogram to the store, replacing any with the same key"""
+        return self.append_many([(name, specgram, sample_freq, frame_len, spec_size, hop)])[0]
+
+    def append_many(self, records):
+        """
+        Adds several (name, specgram, sample_freq, frame_len, spec_size) records
+        to the store, optionally followed by their hop, writing the index once.
+        Returns their keys.
+        """
+        self.refresh()
+        entries = dict(self.entries)
+        keys = []
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "r+b" if self._index_offset is not None else "w+b") as f:
+            # data goes after everything already written, including the old index
+            end = max(f.seek(0, 2), HEADER_SIZE)
+            for record in records:
+                name, specgram, sample_freq, frame_len, spec_size = record[:5]
+                hop = record[5] if len(record) > 5 else 0
+                bands = np.shape(specgram)[1]
+                data, scale, db_offset = quantize(specgram, self.dtype, self.decimate)
+                key = record_key(name, sample_freq, frame_len, spec_size, hop)
+                offset = -(-end//ALIGN)*ALIGN
+                f.seek(offset)
+                f.write(data.tobytes())
+                end = f.tell()
+                entries[key] = dict(key=key, name=name, sample_freq=sample_freq,
+                                    frame_len=frame_len, spec_size=spec_size, hop=hop,
+                                    shape=data.shape, dtype=data.dtype.str,
+                                    offset=offset, scale=scale, db_offset=db_offset,
+                                    decimate=self.decimate, bands=bands)
+                keys.append(key)
+
+            index = json.dumps(list(entries.values())).encode("utf-8")
+            f.seek(end)
+            f.write(index)
+            f.flush()
+            os.fsync(f.fileno())
+
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, len(entries), end, len(index)).ljust(HEADER_SIZE, b"\0"))
+            f.flush()
+        self.refresh()
+        return keys
+
+    def import_npy(self, directory="./record_files"):
+        """Imports recordings saved as name_freq_framelen_specsize.npy files"""
+        records = []
+        for file in sorted(glob.glob(os.path.join(directory, "*.npy"))):
+            fields = os.path.basename(file)[:-len(".npy")].rsplit("_", 3)
+            try:
+                name = fields[0]
+                sample_freq, frame_len, spec_size = [int(field) for field in fields[1:]]
+            except ValueError:
+                print("[+] Skipping {}, unable to parse file name".format(file))
+                continue
+            records.append((name, np.load(file), sample_freq, frame_len, spec_size))
+        return self.append_many(records)
+
+
+if __name__ == "__main__":
+    # import the recordings in a directory of .npy files into its store
+    parser = argparse.ArgumentParser(description="Import .npy recordings into a record store")
+    parser.add_argument("directory", nargs="?", default="./record_files")
+    parser.add_argument("--dtype", choices=["uint8", "float16", "float64"], default="uint8",
+                        help="type the spectrograms are stored as")
+    parser.add_argument("--decimate", type=int, default=1,
+                        help="number of adjacent frequency bands averaged together")
+    args = parser.parse_args()
+
+    store = RecordStore(os.path.join(args.directory, "records.spec"), args.dtype, args.decimate)
+    keys = store.import_npy(args.directory)
+    print("Imported {} recordings, store holds {}".format(len(keys), len(store)))
@@ -0,0 +1,308 @@
+import time
+import argparse
+import logging as log
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+MAGIC = b"SPECSHM1"
+HEADER_SIZE = 64
+# magic, slots, maximum frame length, number of results published
+HEADER = np.dtype([("magic", "S8"), ("slots", "<u4"), ("max_frame_len", "<u4"), ("head", "<u8")])
+
+
+def slot_dtype(max_frame_len):
+    """Returns the layout of one ring slot for frames of up to max_frame_len samples"""
+    bands = max_frame_len//2 + 1
+    # seq is odd while the slot is being written and even once it is complete
+    return np.dtype([("seq", "<u8"), ("time", "<f8"), ("sample_freq", "<u4"),
+                     ("frame_len", "<u4"), ("freq_peak", "<f8"),
+                     ("waveform", "<f4", (max_frame_len,)), ("spectrum", "<f4", (bands,)),
+                     ("psd", "<f4", (bands,))])
+
+
+def _attach(name):
+    # readers must not unlink the segment when they exit, which the resource
+    # tracker does for every segment a process opens before Python 3.13
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class SpectrumPublisher:
+    """
+    Publishes processed frames into a shared memory ring that any number of
+    local SpectrumReader processes can read without locks or serial access.
+
+    The segment holds a small header and a ring of fixed size slots, each with
+    the sequence number, time, configuration, peak frequency, filtered
+    waveform, spectrum and power spectral density of one spectrogram row. Each
+    slot is guarded by a sequence lock: its seq is odd while it is being
+    written, so readers detect and discard torn or overwritten slots instead of
+    blocking the publisher.
+
+    Parameters
+    ----------
+    name : str
+        Name of the shared memory segment.
+    slots : int
+        Number of results held in the ring.
+    max_frame_len : int
+        Largest frame length that can be published.
+
+    Attributes
+    ----------
+    head : int
+        Number of results published.
+
+    Public Methods
+    --------------
+    publish(self, sample_freq, waveform, spectrum, psd, freq_peak):
+        Writes one result into the ring.
+
+    publish_batch(self, sample_freq, wf_data, sp_data, psd, freq_peak, row_frames=None):
+        Writes the output of DataLogger.process_batch into the ring.
+
+    close(self):
+        Detaches from and removes the segment.
+    """
+
+    def __init__(self, name="spectrum", slots=256, max_frame_len=1024):
+        self.dtype = slot_dtype(max_frame_len)
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True,
+                                                  size=HEADER_SIZE + slots*self.dtype.itemsize)
+        except FileExistsError:
+            # left behind by a publisher that did not exit cleanly
+            shared_memory.SharedMemory(name).unlink()
+            self.shm = shared_memory.SharedMemory(name, create=True,
+                                                  size=HEADER_SIZE + slots*self.dtype.itemsize)
+        self.header = np.ndarray((), HEADER, buffer=self.shm.buf)
+        self.slots = np.ndarray(slots, self.dtype, buffer=self.shm.buf, offset=HEADER_SIZE)
+        self.slots["seq"] = 0
+        self.header["slots"] = slots
+        self.header["max_frame_len"] = max_frame_len
+        self.header["head"] = 0
+        self.header["magic"] = MAGIC
+        return
+
+    @property
+    def head(self):
+        return int(self.header["head"])
+
+    def publish(self, sample_freq, waveform, spectrum, psd, freq_peak):
+        """Writes one result into the ring, overwriting the oldest"""
+        seq = self.head
+        slot = self.slots[seq % len(self.slots)]
+        frame_len, bands = len(waveform), len(spectrum)
+        slot["seq"] = 2*seq + 1
+        slot["time"] = time.time()
+        slot["sample_freq"] = sample_freq
+        slot["frame_len"] = frame_len
+        slot["freq_peak"] = freq_peak
+        slot["waveform"][:frame_len] = waveform
+        slot["spectrum"][:bands] = spectrum
+        slot["psd"][:bands] = psd
+        slot["seq"] = 2*seq + 2
+        self.header["head"] = seq + 1
+        return
+
+    def publish_batch(self, sample_freq, wf_data, sp_data, psd, freq_peak, row_frames=None):
+        """
+        Writes the output of DataLogger.process_batch into the ring, one slot per
+        spectrogram row, each with the filtered frame given by row_frames, from
+        DataLogger.row_frames. By default each row has its own frame, as when
+        no hop is set.
+        """
+        if row_frames is None:
+            row_frames = range(len(sp_data))
+        for spectrum, row, peak, frame in zip(sp_data, psd, freq_peak, row_frames):
+            self.publish(sample_freq, wf_data[frame], spectrum, row, peak)
+        return
+
+    def close(self):
+        """Detaches from and removes the segment"""
+        del self.header, self.slots
+        self.shm.close()
+        self.shm.unlink()
+        return
+
+
+class SpectrumReader:
+    """
+    Reads the results published by a SpectrumPublisher in another process.
+
+    Parameters
+    ----------
+    name : str
+        Name of the shared memory segment.
+
+    Attributes
+    ----------
+    lost : int
+        Number of results overwritten before follow() reached them.
+
+    Public Methods
+    --------------
+    head(self):
+        Returns the number of results published.
+
+    read(self, seq, copy=True):
+        Returns the result with the given sequence number.
+
+    follow(self, poll=0.005):
+        Yields every new result as it is published.
+
+    spectrogram(self, rows):
+        Returns the psd of the latest rows, newest first.
+
+    close(self):
+        Detaches from the segment.
+    """
+
+    def __init__(self, name="spectrum"):
+        self.shm = _attach(name)
+        self.header = np.ndarray((), HEADER, buffer=self.shm.buf)
+        if bytes(self.header["magic"]) != MAGIC:
+            raise ValueError("{} is not a spectrum ring".format(name))
+        slots, max_frame_len = int(self.header["slots"]), int(self.header["max_frame_len"])
+        self.slots = np.ndarray(slots, slot_dtype(max_frame_len), buffer=self.shm.buf,
+                                offset=HEADER_SIZE)
+        self.lost = 0
+        return
+
+    def head(self):
+        """Returns the number of results published, one more than the latest sequence number"""
+        return int(self.header["head"])
+
+    def read(self, seq, copy=True):
+        """
+        Returns the result with sequence number seq as a dict, or None if it has
+        not been published yet or has been overwritten. With copy=False the
+        arrays are views onto the ring, and are only valid while valid(seq).
+        """
+        slot = self.slots[seq % len(self.slots)]
+        if slot["seq"] != 2*seq + 2:
+            return None
+        frame_len = int(slot["frame_len"])
+        bands = frame_len//2 + 1
+        result = dict(seq=seq, time=float(slot["time"]), sample_freq=int(slot["sample_freq"]),
+                      frame_len=frame_len, freq_peak=float(slot["freq_peak"]),
+                      waveform=slot["waveform"][:frame_len], spectrum=slot["spectrum"][:bands],
+                      psd=slot["psd"][:bands])
+        if copy:
+            for field in ("waveform", "spectrum", "psd"):
+                result[field] = result[field].copy()
+            if not self.valid(seq):
+                return None
+        return result
+
+    def valid(self, seq):
+        """Returns True if the slot holding seq has not been overwritten"""
+        return self.slots[seq % len(self.slots)]["seq"] == 2*seq + 2
+
+    def follow(self, poll=0.005):
+        """
+        Yields every result published from now on, in order, skipping and
+        counting in lost any that are overwritten before they are read.
+        """
+        seq = self.head()
+        while True:
+            if seq >= self.head():
+                time.sleep(poll)
+                continue
+            if self.head() - seq > len(self.slots):
+                self.lost += self.head() - len(self.slots) - seq
+                seq = self.head() - len(self.slots)
+            result = self.read(seq)
+            if result is None:
+                self.lost += 1
+            else:
+                yield result
+            seq += 1
+
+    def spectrogram(self, rows):
+        """Returns the psd of up to rows of the latest results with the latest frame length, newest first"""
+        head = self.head()
+        psd = []
+        for seq in range(head - 1, max(head - 1 - min(rows, len(self.slots)), -1), -1):
+            result = self.read(seq)
+            if result is None or (psd and len(result["psd"]) != len(psd[0])):
+                break
+            psd.append(result["psd"])
+        return np.array(psd)
+
+    def close(self):
+        """Detaches from the segment"""
+        del self.header, self.slots
+        self.shm.close()
+        return
+
+
+def publish(board, name="spectrum", slots=256, hop=None):
+    """
+    Headless publisher: acquires frames from board, processes them with a
+    DataLogger and publishes every result until interrupted.
+    """
+    from acquisition import FrameAcquirer
+    from data_logger import DataLogger
+
+    publisher = SpectrumPublisher(name, slots)
+    logger = DataLogger(board.sample_no, board.sample_freq, hop=hop)
+    board.send_command("Send Data")
+    acquirer = FrameAcquirer(board)
+    acquirer.start()
+    try:
+        while True:
+            frames = acquirer.buffer.get_all()
+            if len(frames) == 0:
+                time.sleep(0.005)
+                continue
+            if frames.shape[1] != logger.frame_len:
+                logger.set_frame_len(frames.shape[1])
+            if board.sample_freq != logger.sample_freq:
+                logger.set_sample_freq(board.sample_freq)
+            sp_data, psd, freq_peak, wf_data = logger.process_batch(frames)
+            publisher.publish_batch(logger.sample_freq, wf_data, sp_data, psd, freq_peak,
+                                    logger.row_frames(len(psd), len(frames)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        acquirer.stop()
+        log.info("[+] Published {} results".format(publisher.head))
+        publisher.close()
+
+
+def watch(name="spectrum"):
+    """Prints the peak frequency of every published result until interrupted"""
+    reader = SpectrumReader(name)
+    try:
+        for result in reader.follow():
+            print("{seq:>8} {sample_freq:>6} Hz {frame_len:>5} {freq_peak:>9.2f} Hz".format(**result))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("[+] {} results lost".format(reader.lost))
+        reader.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish processed spectra to shared memory, or watch them")
+    parser.add_argument("action", choices=["publish", "watch"])
+    parser.add_argument("--name", default="spectrum", help="shared memory segment name")
+    parser.add_argument("--port", default="/dev/ttyACM0", help="port the Arduino is connected to")
+    parser.add_argument("--simulate", action="store_true", help="publish from an emulated board")
+    parser.add_argument("--slots", type=int, default=256, help="number of results held in the ring")
+    parser.add_argument("--hop", type=int, help="samples between overlapping spectrogram rows")
+    args = parser.parse_args()
+
+    if args.action == "watch":
+        watch(args.name)
+    elif args.simulate:
+        from simulator import SimulatedBoard
+        publish(SimulatedBoard(realtime=True), args.name, args.slots, args.hop)
+    else:
+        from arduino import ArduinoBoard
+        publish(ArduinoBoard(args.port, 230400, timeout=5), args.name, args.slots, args.hop)
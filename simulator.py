@@ -0,0 +1,390 @@
+import os
+import pty
+import sys
+import tty
+import time
+import select
+import argparse
+import threading
+import logging as log
+import numpy as np
+from arduino import ArduinoBoard, pack_frame
+from capture import CaptureReader
+
+FRAME_CMDS = {'a': 256, 'b': 512, 'c': 800, 'd': 1024}
+SAMPLE_CMDS = {0: 4000, 8: 7000, 9: 9000}
+SETUP, FFT, AUDIO = 0, 1, 2
+
+
+class ToneSource:
+    """
+    Synthetic signal made up of sine tones and optional white noise.
+
+    Parameters
+    ----------
+    freqs : iterable of float
+        Frequencies of the tones in Hz.
+    amplitude : float
+        Peak amplitude of each tone, in int8 counts.
+    noise : float
+        Standard deviation of the added white noise, in int8 counts.
+    seed : int
+        Seed for the noise generator.
+    """
+
+    def __init__(self, freqs=(440,), amplitude=60, noise=0, seed=None):
+        self.freqs = np.asarray(freqs, dtype=float)
+        self.amplitude = amplitude
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+        self.t = 0.  # time of the next sample, kept continuous across frames
+        return
+
+    def read(self, n, sample_freq):
+        """Returns the next n samples as int8 at the given sample rate."""
+        t = self.t + np.arange(n)/sample_freq
+        self.t += n/sample_freq
+        data = self.amplitude*np.sin(2*np.pi*np.outer(t, self.freqs)).sum(axis=1)
+        if self.noise:
+            data += self.rng.normal(0, self.noise, n)
+        return np.clip(data, -127, 127).astype(np.int8)
+
+
+class ReplaySource:
+    """
+    Replays recorded int8 samples, ignoring the requested sample rate.
+
+    Parameters
+    ----------
+    samples : array_like or str
+        Recorded samples, or the path of a .npy file or capture containing them.
+    loop : bool
+        Restart from the beginning once the recording is exhausted, otherwise
+        pad with silence.
+    """
+
+    def __init__(self, samples, loop=True):
+        if isinstance(samples, str) and samples.endswith(".npy"):
+            samples = np.load(samples)
+        elif isinstance(samples, str):
+            samples = CaptureReader(samples).samples()
+        self.samples = np.asarray(samples).astype(np.int8).ravel()
+        self.loop = loop
+        self.pos = 0
+        return
+
+    def read(self, n, sample_freq):
+        """Returns the next n recorded samples."""
+        out = np.zeros(n, dtype=np.int8)
+        filled = 0
+        while filled < n and self.pos < len(self.samples):
+            chunk = self.samples[self.pos:self.pos + n - filled]
+            out[filled:filled + len(chunk)] = chunk
+            filled += len(chunk)
+            self.pos += len(chunk)
+            if self.loop and self.pos == len(self.samples):
+                self.pos = 0
+        return out
+
+
+class FirmwareEmulator:
+    """
+    Serial-port-like object that emulates the Analyser firmware in
+    src/spec_analyser.cpp: the setup banner, the single character command
+    acknowledgements and int8 frames, framed with a header and CRC as
+    described in FrameParser or raw.
+
+    Parameters
+    ----------
+    source : ToneSource() or ReplaySource()
+        Signal the emulated board samples. Defaults to a 440 Hz tone.
+    frame_len : int
+        Initial number of samples in a frame.
+    sample_freq : int
+        Initial sampling frequency.
+    realtime : bool
+        Pace frames at the rate the real board would send them, otherwise
+        produce them as fast as they are read.
+    framed : bool
+        Send frames with a header and CRC, otherwise send raw samples.
+
+    Attributes
+    ----------
+    mode : int
+        Firmware state, SETUP, FFT or AUDIO. Frames are only sent in AUDIO.
+    LED : int
+        Pin of the LED that is currently lit.
+    frames : int
+        Number of frames sent.
+
+    Public Methods
+    --------------
+    read(self, size):
+        Returns up to size bytes from the board.
+
+    readinto(self, b):
+        Reads bytes from the board into a writable buffer.
+
+    readline(self):
+        Returns bytes from the board up to and including a newline.
+
+    write(self, data):
+        Queues command bytes for the firmware.
+
+    step(self):
+        Runs one iteration of the firmware loop and returns all pending output.
+
+    reset(self):
+        Restarts the firmware, sending the setup banner again.
+    """
+
+    def __init__(self, source=None, frame_len=1024, sample_freq=4000, realtime=False,
+                 framed=True):
+        self.source = source if source is not None else ToneSource()
+        self.framed = framed
+        self.frame_len = frame_len
+        self.sample_freq = sample_freq
+        self.realtime = realtime
+        self.frames = 0
+        self._lock = threading.Lock()
+        self.reset()
+        return
+
+    def reset(self):
+        """Restarts the firmware, as opening the port resets a real board."""
+        self.mode = SETUP
+        self.LED = 0
+        self._in = bytearray()
+        self._out = bytearray()
+        self._deadline = time.perf_counter()
+
+        self._println("Setup Complete")
+        self._println("Sample no: {}".format(self.frame_len))
+        self._println("Sample freq: {}".format(self.sample_freq))
+        return
+
+    @property
+    def in_waiting(self):
+        return len(self._out)
+
+    def _println(self, line):
+        self._out.extend((line + "\r\n").encode("utf-8"))
+
+    def read_terminal(self):
+        """Handles a single pending command byte, as the firmware does."""
+        if not self._in:
+            return
+        cmd = chr(self._in.pop(0))
+
+        if cmd in FRAME_CMDS:
+            self.frame_len = FRAME_CMDS[cmd]
+            self._println("Recieved: {}".format(cmd))
+            return
+        cmd = ord(cmd) - ord('0')
+
+        if cmd < 0:
+            self._println("Command Not Found")
+        elif cmd in SAMPLE_CMDS:
+            self.sample_freq = SAMPLE_CMDS[cmd]
+        elif cmd < 3:
+            self.mode = cmd
+        elif cmd < 8:
+            # mirror the firmware swapping the two reversed LEDs
+            self.LED = {6: 7, 7: 6}.get(cmd, cmd)
+
+        if 0 <= cmd <= 9:
+            self._println("Recieved: {}".format(cmd))
+        else:
+            self._println("Command Not Found")
+        return
+
+    def collect_data(self):
+        """Samples a frame from the source, pacing it if running in real time."""
+        data = self.source.read(self.frame_len, self.sample_freq)
+        if self.realtime:
+            self._deadline = max(self._deadline, time.perf_counter() - 1)
+            self._deadline += self.frame_len/self.sample_freq
+            delay = self._deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def loop(self):
+        """Runs one iteration of the firmware's main loop."""
+        self.read_terminal()
+        data = self.collect_data()
+        if self.mode == AUDIO:
+            if self.framed:
+                self._out.extend(pack_frame(self.frames, self.sample_freq, data.tobytes()))
+            else:
+                self._out.extend(data.tobytes())
+            self.frames += 1
+        return
+
+    def _idle(self):
+        # the firmware produces nothing until it is commanded
+        return self.mode != AUDIO and not self._in
+
+    def read(self, size=1):
+        """Returns up to size bytes, fewer if the board would have timed out."""
+        with self._lock:
+            while len(self._out) < size and not self._idle():
+                self.loop()
+            data = bytes(self._out[:size])
+            del self._out[:size]
+        return data
+
+    def readinto(self, b):
+        """Reads bytes from the board into a writable buffer."""
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        """Returns bytes up to and including a newline."""
+        with self._lock:
+            while b"\n" not in self._out and not self._idle():
+                self.loop()
+            end = self._out.find(b"\n") + 1 or len(self._out)
+            data = bytes(self._out[:end])
+            del self._out[:end]
+        return data
+
+    def write(self, data):
+        """Queues command bytes for the firmware."""
+        with self._lock:
+            self._in.extend(data)
+        return len(data)
+
+    def step(self):
+        """Runs one iteration of the firmware loop and returns all pending output."""
+        with self._lock:
+            if not self._idle():
+                self.loop()
+            data = bytes(self._out)
+            self._out.clear()
+        return data
+
+    def close(self):
+        return
+
+
+class SimulatedBoard(ArduinoBoard):
+    """
+    Drop in replacement for ArduinoBoard that talks to an in-process
+    FirmwareEmulator instead of a serial port.
+
+    Parameters
+    ----------
+    source : ToneSource() or ReplaySource()
+        Signal the emulated board samples.
+    frame_len : int
+        Initial number of samples in a frame.
+    sample_freq : int
+        Initial sampling frequency.
+    realtime : bool
+        Pace frames at the rate the real board would send them.
+    framed : bool
+        Emulate the framed protocol, otherwise send raw samples.
+    """
+
+    def __init__(self, source=None, frame_len=1024, sample_freq=4000, realtime=False,
+                 framed=True):
+        self.board = FirmwareEmulator(source, frame_len, sample_freq, realtime, framed)
+        self.connect(framed)
+        return
+
+
+class PtyBridge(threading.Thread):
+    """
+    Serves a FirmwareEmulator on a pseudo terminal, so that an unmodified
+    ArduinoBoard (or any other serial client) can connect to it by port name.
+
+    Like a real board, which is reset when its port is opened, the emulator is
+    restarted boot_delay seconds after each client connects. Nothing is sent
+    while no client has the port open, so the setup banner is never lost to
+    the input flush serial clients do when opening a port.
+
+    Parameters
+    ----------
+    emulator : FirmwareEmulator()
+        Emulated board to serve.
+    boot_delay : float
+        Seconds between a client connecting and the firmware starting.
+
+    Attributes
+    ----------
+    port : str
+        Name of the pseudo terminal to connect to.
+    """
+
+    def __init__(self, emulator, boot_delay=0.1):
+        super().__init__(daemon=True)
+        self.emulator = emulator
+        self.boot_delay = boot_delay
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        # with the slave closed, reading the master fails until a client opens the port
+        os.close(slave)
+        self._stop_event = threading.Event()
+        return
+
+    def run(self):
+        connected = False
+        while not self._stop_event.is_set():
+            ready, _, _ = select.select([self.master], [], [], 0.01)
+            if ready:
+                try:
+                    self.emulator.write(os.read(self.master, 64))
+                except OSError:
+                    connected = False
+                    time.sleep(0.01)
+                    continue
+            if not connected:
+                connected = True
+                time.sleep(self.boot_delay)
+                self.emulator.reset()
+            data = self.emulator.step()
+            try:
+                while data:
+                    data = data[os.write(self.master, data):]
+            except OSError:
+                connected = False
+        return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        os.close(self.master)
+        return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve an emulated Arduino on a pty")
+    parser.add_argument("--tone", type=float, nargs="+", default=[440],
+                        help="frequencies of the synthetic tones in Hz")
+    parser.add_argument("--noise", type=float, default=0, help="white noise level")
+    parser.add_argument("--replay", help="capture or .npy file of int8 samples to replay")
+    parser.add_argument("--frame", type=int, default=1024, help="initial frame length")
+    parser.add_argument("--sample", type=int, default=4000, help="initial sample frequency")
+    parser.add_argument("--fast", action="store_true",
+                        help="send frames as fast as possible rather than in real time")
+    parser.add_argument("--raw", action="store_true",
+                        help="send raw samples, as firmware without the framed protocol does")
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        source = ReplaySource(args.replay)
+    else:
+        source = ToneSource(args.tone, noise=args.noise)
+    bridge = PtyBridge(FirmwareEmulator(source, args.frame, args.sample,
+                                        realtime=not args.fast, framed=not args.raw))
+    bridge.start()
+    print("[+] Emulated board on {}".format(bridge.port))
+    sys.stdout.flush()
+    try:
+        while bridge.is_alive():
+            bridge.join(1)
+    except KeyboardInterrupt:
+        log.info("[+] Emulated board sent {} frames".format(bridge.emulator.frames))
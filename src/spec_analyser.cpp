@@ -1,10 +1,12 @@
 #include "spec_analyser.h"
+#include <util/crc16.h>
 
 Analyser::Analyser()
 {
     mode = state::SETUP;
     frame_len = FRAME_LEN;
     sample_freq = SAMPLE_FREQ1;
+    seq = 0;
     pinMode(3, OUTPUT);
     pinMode(4, OUTPUT);
     pinMode(5, OUTPUT);
@@ -106,6 +108,18 @@ void Analyser::send_data()
 {
     if(mode == state::AUDIO)
     {
+        uint8_t header[HEADER_LEN] = {SYNC1, SYNC2,
+                                      lowByte(seq), highByte(seq),
+                                      lowByte(frame_len), highByte(frame_len),
+                                      lowByte(sample_freq), highByte(sample_freq)};
+        uint16_t crc = 0;
+        for(int i=2; i<HEADER_LEN; i++) crc = _crc_xmodem_update(crc, header[i]);
+        for(int i=0; i<frame_len; i++) crc = _crc_xmodem_update(crc, data[i]);
+
+        Serial.write(header, HEADER_LEN);
         Serial.write(data, frame_len);
+        Serial.write(lowByte(crc));
+        Serial.write(highByte(crc));
+        seq++;
     }
 }
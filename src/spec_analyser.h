@@ -10,6 +10,12 @@
 #define FILTER_GAIN 1
 #define BAUD 230400
 
+// frame header: sync word, sequence number, frame length and sample frequency,
+// followed by the samples and a CRC-16/XMODEM of everything after the sync word
+#define SYNC1 0xA5
+#define SYNC2 0x5A
+#define HEADER_LEN 8
+
 enum class state{SETUP, FFT, AUDIO};
 
 class Analyser
@@ -18,6 +24,7 @@ public:
     state mode;
     int frame_len;
     int sample_freq;
+    unsigned int seq;
     char data[FRAME_LEN];
 
     Analyser();
@@ -0,0 +1,201 @@
+import sys
+import json
+import time
+import importlib
+import threading
+import contextlib
+import numpy as np
+
+# histogram bin edges in seconds, 10 us to 10 s
+BIN_EDGES = np.logspace(-5, 1, 13)
+
+
+class StageStats:
+    """
+    Rolling window of the durations of one pipeline stage.
+
+    Parameters
+    ----------
+    window : int
+        Number of most recent durations kept.
+
+    Attributes
+    ----------
+    count : int
+        Total number of durations recorded.
+    total : float
+        Total time recorded, in seconds.
+    """
+
+    def __init__(self, window=1000):
+        self._times = np.zeros(window)
+        self._index = 0
+        self.count = 0
+        self.total = 0.
+        return
+
+    def add(self, seconds):
+        self._times[self._index] = seconds
+        self._index = (self._index + 1) % len(self._times)
+        self.count += 1
+        self.total += seconds
+
+    def summary(self):
+        """Returns the count, mean and percentiles in ms, and a histogram of the window"""
+        times = self._times[:min(self.count, len(self._times))]
+        if len(times) == 0:
+            return dict(count=0)
+        p50, p95, p99 = np.percentile(times, [50, 95, 99])*1e3
+        histogram, _ = np.histogram(times, BIN_EDGES)
+        return dict(count=self.count, total_s=self.total, mean_ms=times.mean()*1e3,
+                    p50_ms=p50, p95_ms=p95, p99_ms=p99, max_ms=times.max()*1e3,
+                    histogram=histogram.tolist())
+
+
+class Stats:
+    """
+    Registry of per-stage timings and counters for the acquisition and
+    processing pipeline.
+
+    Parameters
+    ----------
+    window : int
+        Number of most recent durations kept for each stage.
+
+    Public Methods
+    --------------
+    timer(self, stage):
+        Context manager that records how long its body takes under stage.
+
+    add(self, stage, seconds):
+        Records a duration for a stage.
+
+    count(self, name, n=1):
+        Increments a counter.
+
+    gauge(self, name, func):
+        Registers a callable whose value is reported as a counter.
+
+    summary(self):
+        Returns every stage and counter as a JSON serialisable dict.
+
+    report(self):
+        Returns the summary formatted as a table.
+
+    dump(self, path):
+        Writes the summary to a JSON file.
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.stages = dict()
+        self.counters = dict()
+        self.gauges = dict()
+        self._lock = threading.Lock()
+        return
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Records how long the body of the with statement takes under stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        """Records a duration, in seconds, for a stage"""
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = StageStats(self.window)
+            self.stages[stage].add(seconds)
+
+    def count(self, name, n=1):
+        """Increments a counter"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, func):
+        """Registers a callable, e.g. a dropped frame count, reported as a counter"""
+        self.gauges[name] = func
+
+    def summary(self):
+        """Returns every stage and counter as a JSON serialisable dict"""
+        with self._lock:
+            stages = dict((name, stage.summary()) for name, stage in self.stages.items())
+            counters = dict(self.counters)
+        for name, func in list(self.gauges.items()):
+            counters[name] = func()
+        return dict(time=time.time(), stages=stages, counters=counters)
+
+    def report(self):
+        """Returns the summary formatted as a table"""
+        summary = self.summary()
+        lines = ["{:<14}{:>9}{:>10}{:>10}{:>10}{:>10}".format("stage", "count", "mean ms",
+                                                             "p50 ms", "p99 ms", "max ms")]
+        for name, stage in sorted(summary["stages"].items()):
+            if stage["count"]:
+                lines.append("{:<14}{:>9}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+                    name, stage["count"], stage["mean_ms"], stage["p50_ms"],
+                    stage["p99_ms"], stage["max_ms"]))
+        for name, value in sorted(summary["counters"].items()):
+            lines.append("{:<14}{:>9}".format(name, value))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Writes the summary to a JSON file"""
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class StatsReporter(threading.Thread):
+    """
+    Periodically prints the stats report and, optionally, dumps it to a JSON file.
+
+    Parameters
+    ----------
+    stats : Stats()
+        Registry to report.
+    interval : float
+        Seconds between reports.
+    path : str
+        JSON file the summary is written to each interval, if given.
+    """
+
+    def __init__(self, stats, interval=10, path=None):
+        super().__init__(daemon=True)
+        self.stats = stats
+        self.interval = interval
+        self.path = path
+        self._stop_event = threading.Event()
+        return
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            print("[+] Stats:\n{}".format(self.stats.report()))
+            if self.path is not None:
+                self.stats.dump(self.path)
+        return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return
+
+
+# default registry shared by the board, logger and GUI
+STATS = Stats()
+
+
+def lazy_import(name):
+    """
+    Returns the named module, importing it on first use and recording how long
+    the import took under the stage import:<name>. Used for the heavy matching
+    and imaging libraries so that they only load once they are needed.
+    """
+    module = sys.modules.get(name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        STATS.add("import:" + name, time.perf_counter() - start)
+    return module
@@ -0,0 +1,263 @@
+import sys
+import json
+import time
+import queue
+import argparse
+import logging as log
+import multiprocessing as mp
+import serial
+from arduino import ArduinoBoard
+from acquisition import FrameAcquirer
+from data_logger import DataLogger
+from stats import STATS
+
+DEFAULT_BAUD = 230400
+
+
+def run_device(config, results, stop_event, interval=1.):
+    """
+    Acquires and processes frames from one board until stop_event is set,
+    putting ("result", name, dict) messages for every batch of frames and
+    ("stats", name, dict) messages every interval seconds onto results.
+
+    Runs in its own process, started by Supervisor.
+    """
+    name = config["name"]
+    try:
+        board = ArduinoBoard(config["port"], config.get("baud", DEFAULT_BAUD),
+                             config.get("timeout", 5), framed=config.get("framed", True))
+        board.send_command("Send Data")
+    except (serial.SerialException, RuntimeError, OSError) as e:
+        results.put(("error", name, str(e)))
+        return
+
+    logger = DataLogger(board.sample_no, board.sample_freq, spec_size=config.get("spec_size", 100),
+                        record_dir=config.get("record_dir", "./record_files"),
+                        hop=config.get("hop"))
+    acquirer = FrameAcquirer(board, capacity=config.get("capacity", 64))
+    acquirer.start()
+
+    frames = 0
+    lost = 0
+    last_frames = 0
+    last_report = time.perf_counter()
+    while not stop_event.is_set():
+        batch = acquirer.buffer.get_all()
+        if len(batch) == 0:
+            time.sleep(0.005)
+        else:
+            if batch.shape[1] != logger.frame_len:
+                logger.set_frame_len(batch.shape[1])
+            if board.sample_freq != logger.sample_freq:
+                logger.set_sample_freq(board.sample_freq)
+
+            with STATS.timer("process"):
+                sp_data, psd, peaks, wf_data = logger.process_batch(batch)
+            tuning = logger.tune()
+            note, LED = tuning[1:] if tuning is not None else (None, None)
+            frames += len(batch)
+            try:
+                results.put_nowait(("result", name, dict(
+                    time=time.time(), frames=len(batch), sample_freq=logger.sample_freq,
+                    frame_len=logger.frame_len, peaks=peaks.tolist(),
+                    note=None if note is None else float(note),
+                    LED=None if LED is None else int(LED))))
+            except queue.Full:
+                lost += 1
+
+        now = time.perf_counter()
+        if now - last_report >= interval:
+            parser = board.parser
+            health = dict(frames=frames, fps=(frames - last_frames)/(now - last_report),
+                          dropped=acquirer.dropped, overruns=acquirer.overruns,
+                          results_lost=lost,
+                          crc_errors=parser.crc_errors if parser is not None else 0,
+                          frame_gaps=parser.gaps if parser is not None else 0,
+                          stats=STATS.summary())
+            try:
+                results.put_nowait(("stats", name, health))
+            except queue.Full:
+                pass
+            last_frames, last_report = frames, now
+
+    acquirer.stop()
+    board.board.close()
+    return
+
+
+class Supervisor:
+    """
+    Runs acquisition and DataLogger processing for several boards, each in its
+    own process so that they scale across cores, and gathers their results and
+    health on a single queue.
+
+    Parameters
+    ----------
+    configs : list of dict
+        One entry per board with its "port" and optionally "name", "baud",
+        "timeout", "framed", "hop", "spec_size", "capacity" and "record_dir".
+        The name defaults to the port.
+    queue_size : int
+        Maximum number of results waiting to be consumed before workers start
+        discarding them.
+    interval : float
+        Seconds between each worker's health reports.
+
+    Attributes
+    ----------
+    health : dict
+        Latest health of each board, keyed by name: whether its process is
+        alive, when it last reported, its frame count and rate, dropped frames,
+        serial overruns, CRC errors, sequence gaps, results discarded and the
+        last error.
+
+    Public Methods
+    --------------
+    start(self):
+        Starts a worker process for every board.
+
+    poll(self, timeout=0.1):
+        Returns the next (kind, name, payload) message from the workers.
+
+    results(self):
+        Yields (name, result) for every processed batch until stopped.
+
+    report(self):
+        Returns the health of every board formatted as a table.
+
+    stop(self):
+        Stops every worker process.
+    """
+
+    def __init__(self, configs, queue_size=1024, interval=1.):
+        self.configs = [dict(config) for config in configs]
+        for config in self.configs:
+            config.setdefault("name", config["port"])
+        names = [config["name"] for config in self.configs]
+        if len(set(names)) != len(names):
+            raise ValueError("Board names must be unique: {}".format(names))
+
+        self.interval = interval
+        self.queue = mp.Queue(queue_size)
+        self.processes = dict()
+        self.health = dict((name, dict(alive=False, last_seen=None, frames=0, fps=0.,
+                                       error=None)) for name in names)
+        self._stop_event = mp.Event()
+        return
+
+    def start(self):
+        """Starts a worker process for every board"""
+        for config in self.configs:
+            process = mp.Process(target=run_device, name=config["name"], daemon=True,
+                                 args=(config, self.queue, self._stop_event, self.interval))
+            process.start()
+            self.processes[config["name"]] = process
+        return
+
+    def poll(self, timeout=0.1):
+        """
+        Returns the next ("result" | "stats" | "error", name, payload) message
+        from the workers, or None if there is none within timeout seconds.
+        """
+        for name, process in self.processes.items():
+            self.health[name]["alive"] = process.is_alive()
+        try:
+            kind, name, payload = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+        health = self.health[name]
+        health["last_seen"] = time.time()
+        if kind == "stats":
+            health.update((k, v) for k, v in payload.items() if k != "stats")
+        elif kind == "error":
+            health["error"] = payload
+            print("[+] {}: {}".format(name, payload))
+        return kind, name, payload
+
+    def results(self):
+        """Yields (name, result) for every processed batch until the supervisor is stopped"""
+        while not self._stop_event.is_set():
+            message = self.poll()
+            if message is not None and message[0] == "result":
+                yield message[1], message[2]
+            elif not any(process.is_alive() for process in self.processes.values()):
+                return
+
+    def report(self):
+        """Returns the health of every board formatted as a table"""
+        lines = ["{:<16}{:>6}{:>10}{:>9}{:>9}{:>9}{:>6}{:>6}".format(
+            "board", "alive", "frames", "fps", "dropped", "overrun", "crc", "gaps")]
+        for name, health in self.health.items():
+            lines.append("{:<16}{:>6}{:>10}{:>9.1f}{:>9}{:>9}{:>6}{:>6}".format(
+                name, "yes" if health["alive"] else "no", health["frames"], health["fps"],
+                health.get("dropped", 0), health.get("overruns", 0),
+                health.get("crc_errors", 0), health.get("frame_gaps", 0)))
+        return "\n".join(lines)
+
+    def stop(self, timeout=5):
+        """Stops every worker process, terminating any that do not exit within timeout"""
+        self._stop_event.set()
+        for process in self.processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Acquire and process several boards at once")
+    parser.add_argument("config", nargs="?",
+                        help="JSON list of board configs, each with at least a port")
+    parser.add_argument("--ports", nargs="+", default=[], help="ports of boards to open")
+    parser.add_argument("--simulate", type=int, default=0,
+                        help="number of emulated boards served on ptys")
+    parser.add_argument("--interval", type=float, default=5,
+                        help="seconds between health reports")
+    parser.add_argument("--duration", type=float, help="seconds to run for, defaults to forever")
+    parser.add_argument("--results", action="store_true", help="print every result")
+    args = parser.parse_args()
+
+    configs = [dict(port=port) for port in args.ports]
+    if args.config is not None:
+        with open(args.config) as f:
+            configs += json.load(f)
+
+    bridges = []
+    if args.simulate:
+        from simulator import FirmwareEmulator, PtyBridge, ToneSource
+        for i in range(args.simulate):
+            source = ToneSource((220*2**(i/12),), noise=2)
+            bridge = PtyBridge(FirmwareEmulator(source, realtime=True))
+            bridge.start()
+            bridges.append(bridge)
+            configs.append(dict(port=bridge.port, name="sim{}".format(i)))
+    if not configs:
+        parser.error("no boards given")
+
+    supervisor = Supervisor(configs, interval=min(args.interval, 1.))
+    supervisor.start()
+    start = last_report = time.perf_counter()
+    try:
+        while args.duration is None or time.perf_counter() - start < args.duration:
+            message = supervisor.poll()
+            if message is not None and message[0] == "result" and args.results:
+                print("{}: {}".format(message[1], message[2]))
+            if time.perf_counter() - last_report >= args.interval:
+                print("[+] Boards:\n{}".format(supervisor.report()))
+                sys.stdout.flush()
+                last_report = time.perf_counter()
+            if supervisor.processes and not any(p.is_alive() for p in supervisor.processes.values()):
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+        for bridge in bridges:
+            bridge.stop()
+        log.info("[+] Supervisor stopped")
+        print("[+] Boards:\n{}".format(supervisor.report()))
+
+
+if __name__ == "__main__":
+    main()
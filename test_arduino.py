@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from arduino import FrameParser, pack_frame
+
+
+def frames(n, frame_len=256, seed=0):
+    rng = np.random.default_rng(seed)
+    return [pack_frame(i, 4000, rng.integers(-128, 128, frame_len, dtype=np.int8).tobytes())
+            for i in range(n)]
+
+
+@pytest.mark.parametrize("ack_after", [5, 7])
+def test_parser_resyncs_and_keeps_acks_clean(ack_after):
+    packed = frames(10)
+    corrupt = bytearray(packed[5])
+    corrupt[100] ^= 0xFF
+    packed[5] = bytes(corrupt)
+    stream = b"".join(packed[:ack_after + 1]) + b"Recieved: 3\r\n" + b"".join(packed[ack_after + 1:])
+
+    parser = FrameParser()
+    received = []
+    for i in range(0, len(stream), 77):
+        parser.feed(stream[i:i + 77])
+        received.extend(parser.frames())
+
+    assert [seq for seq, _, _ in received] == [0, 1, 2, 3, 4, 6, 7, 8, 9]
+    assert list(parser.lines) == [b"Recieved: 3\r\n"]
+    assert parser.crc_errors == 1
+    assert parser.gaps == 1
+    assert parser.skipped == len(packed[5])
@@ -0,0 +1,27 @@
+import os
+import json
+import numpy as np
+from batch_analysis import analyse
+from capture import CaptureWriter
+
+
+def test_analyse_capture_with_stale_sidecar(tmp_path):
+    path = str(tmp_path / "take.cap")
+    rng = np.random.default_rng(0)
+    writer = CaptureWriter(path)
+    writer.write(rng.integers(-128, 128, (100, 256), dtype=np.int8), 4000)
+    writer.write(rng.integers(-128, 128, (40, 512), dtype=np.int8), 9000)
+    writer.close()
+
+    # as left by a writer interrupted before the sidecar caught up
+    with open(path + ".json") as f:
+        sidecar = json.load(f)
+    sidecar["frames"] = 0
+    del sidecar["segments"][1:]
+    with open(path + ".json", "w") as f:
+        json.dump(sidecar, f)
+
+    result = analyse(path, str(tmp_path))
+    assert result["frames"] == 140
+    assert np.load(os.path.join(str(tmp_path), "take_spec0.npy")).shape == (100, 129)
+    assert np.load(os.path.join(str(tmp_path), "take_spec1.npy")).shape == (40, 257)
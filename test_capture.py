@@ -0,0 +1,60 @@
+import json
+import time
+import numpy as np
+import pytest
+from capture import CaptureReader, CaptureWriter
+
+
+def random_frames(n, frame_len, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(-128, 128, (n, frame_len), dtype=np.int8)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_capture_round_trip(tmp_path, compress):
+    path = str(tmp_path / "take.cap")
+    first, second = random_frames(100, 256), random_frames(30, 512, seed=1)
+    writer = CaptureWriter(path, compress=compress)
+    writer.write(first, 4000)
+    writer.write(second, 9000)
+    writer.close()
+
+    reader = CaptureReader(path)
+    assert reader.frames == 130
+    assert reader.segment_lengths() == [100, 30]
+    chunks = list(reader.chunks())
+    assert [freq for _, freq in chunks] == [4000, 4000, 9000]
+    np.testing.assert_array_equal(np.concatenate([frames for frames, _ in chunks[:2]]), first)
+    np.testing.assert_array_equal(chunks[2][0], second)
+    np.testing.assert_array_equal(reader.samples(), np.concatenate((first.ravel(), second.ravel())))
+
+
+def test_unclosed_capture_reads_complete_chunks(tmp_path):
+    path = str(tmp_path / "take.cap")
+    frames = random_frames(200, 256)
+    writer = CaptureWriter(path)
+    writer.write(frames, 4000)
+    deadline = time.perf_counter() + 5
+    while writer.frames < 200 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+    # the last 8 frames are still in the chunk being built
+    with open(path + ".json") as f:
+        assert json.load(f)["frames"] == 192
+    reader = CaptureReader(path)
+    assert reader.frames == 192
+    assert reader.segment_lengths() == [192]
+    np.testing.assert_array_equal(np.concatenate([f for f, _ in reader.chunks()]), frames[:192])
+
+
+def test_capture_cut_short_mid_chunk(tmp_path):
+    path = str(tmp_path / "take.cap")
+    writer = CaptureWriter(path)
+    writer.write(random_frames(128, 256), 4000)
+    writer.close()
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 100)
+
+    reader = CaptureReader(path)
+    assert reader.frames == 64
+    assert sum(len(frames) for frames, _ in reader.chunks()) == 64
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+from data_logger import DataLogger, SpectrogramBuffer
+
+
+def test_spectrogram_buffer_push_many_matches_roll():
+    rng = np.random.default_rng(0)
+    buffer = SpectrogramBuffer(7, 3)
+    expected = np.zeros((7, 3))
+    for n in (1, 3, 7, 10, 2):
+        rows = rng.normal(size=(n, 3))
+        buffer.push_many(rows)
+        for row in rows:
+            expected = np.roll(expected, 1, axis=0)
+            expected[0] = row
+        np.testing.assert_array_equal(buffer.view(), expected)
+
+
+@pytest.mark.parametrize("hop", [None, 64, 100, 256])
+def test_frames_for_rows_is_the_fewest_frames(hop):
+    logger = DataLogger(256, 4000, hop=hop)
+    logger.process_batch(np.zeros((3, 256)))
+    for rows in (1, 2, 5, 17):
+        n_frames = logger.frames_for_rows(rows)
+        history = logger.history
+        if n_frames > 1:
+            assert len(logger.process_batch(np.zeros((n_frames - 1, 256)))[1]) < rows
+            logger.history = history
+        assert len(logger.process_batch(np.zeros((n_frames, 256)))[1]) >= rows
+
+
+def test_recordings_are_matched_with_the_same_hop(tmp_path):
+    hopped = DataLogger(256, 4000, spec_size=10, record_dir=str(tmp_path), hop=64)
+    plain = DataLogger(256, 4000, spec_size=10, record_dir=str(tmp_path))
+    rng = np.random.default_rng(0)
+    hopped_key = hopped.save_record("song", rng.uniform(20, 80, (10, 129)))
+    plain_key = plain.save_record("song", rng.uniform(20, 80, (10, 129)))
+    plain.records.refresh()
+
+    assert plain.records.entries[hopped_key]["hop"] == 64
+    assert plain.candidate_keys() == [plain_key]
+    assert hopped.candidate_keys() == [hopped_key]
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from record_store import RecordStore
+import matching
+
+
+def test_record_store_replaces_and_workers_see_it(tmp_path):
+    path = str(tmp_path / "records.spec")
+    store = RecordStore(path)
+    rng = np.random.default_rng(0)
+    first = rng.uniform(20, 80, (10, 33))
+    key = store.append("song", first, 4000, 64, 10)
+    np.testing.assert_allclose(store.get(key), first, atol=60/255)
+    assert matching._load(path, key) == pytest.approx(store.get(key))
+
+    second = first + 10
+    assert store.append("song", second, 4000, 64, 10) == key
+    assert len(RecordStore(path)) == 1
+    np.testing.assert_allclose(matching._load(path, key), second, atol=60/255)
+
+
+def test_record_store_keeps_hops_apart(tmp_path):
+    path = str(tmp_path / "records.spec")
+    store = RecordStore(path)
+    rng = np.random.default_rng(0)
+    plain = store.append("song", rng.uniform(20, 80, (10, 33)), 4000, 64, 10)
+    hopped = store.append("song", rng.uniform(20, 80, (10, 33)), 4000, 64, 10, hop=16)
+    assert plain != hopped
+
+    store = RecordStore(path)
+    assert len(store) == 2
+    assert store.find(sample_freq=4000, frame_len=64, spec_size=10, hop=0) == [plain]
+    assert store.find(sample_freq=4000, frame_len=64, spec_size=10, hop=16) == [hopped]
+    assert store.find(sample_freq=4000, frame_len=64, hop=16) == [hopped]
+    assert sorted(store.find(name="song")) == sorted([plain, hopped])
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import pytest
+from data_logger import DataLogger
+from shared_spectrum import SpectrumPublisher, SpectrumReader
+
+
+@pytest.fixture
+def ring():
+    name = "spectrum_test_{}".format(os.getpid())
+    publisher = SpectrumPublisher(name, slots=64, max_frame_len=256)
+    reader = SpectrumReader(name)
+    yield publisher, reader
+    reader.close()
+    publisher.close()
+
+
+@pytest.mark.parametrize("hop", [None, 64, 100])
+def test_publish_batch_keeps_each_rows_frame(ring, hop):
+    publisher, reader = ring
+    logger = DataLogger(256, 4000, hop=hop)
+    rng = np.random.default_rng(0)
+    for n_frames in (3, 1, 4):
+        frames = rng.integers(-128, 128, (n_frames, 256)).astype(np.int8)
+        head = publisher.head
+        sp_data, psd, freq_peak, wf_data = logger.process_batch(frames)
+        row_frames = logger.row_frames(len(psd), len(frames))
+        publisher.publish_batch(logger.sample_freq, wf_data, sp_data, psd, freq_peak, row_frames)
+
+        assert publisher.head - head == len(psd)
+        if hop is None:
+            np.testing.assert_array_equal(row_frames, np.arange(n_frames))
+        for i, frame in enumerate(row_frames):
+            result = reader.read(head + i)
+            np.testing.assert_allclose(result["waveform"], wf_data[frame], rtol=1e-6)
+            np.testing.assert_allclose(result["psd"], psd[i], rtol=1e-6)
+
+
+def test_row_frames_match_window_ends():
+    logger = DataLogger(256, 4000, hop=100)
+    total = 0
+    for n_frames in (1, 2, 3, 1, 5):
+        sp_data, psd, freq_peak, wf_data = logger.process_batch(np.zeros((n_frames, 256)))
+        # every row's window ends a whole number of hops after the first window
+        ends = np.arange(logger.frame_len - 1, total + n_frames*256, logger.hop)
+        ends = ends[ends >= total]
+        np.testing.assert_array_equal(logger.row_frames(len(psd), n_frames),
+                                      (ends - total)//256)
+        total += n_frames*256
@@ -0,0 +1,62 @@
+import time
+from arduino import ArduinoBoard
+from simulator import FirmwareEmulator, PtyBridge, SimulatedBoard, ToneSource
+
+
+class CorruptingEmulator(FirmwareEmulator):
+    """FirmwareEmulator that flips a byte in the samples of one frame"""
+
+    def __init__(self, *args, corrupt_frame=3, **kwargs):
+        self.corrupt_frame = corrupt_frame
+        super().__init__(*args, **kwargs)
+
+    def loop(self):
+        start = len(self._out)
+        frames = self.frames
+        super().loop()
+        if frames == self.corrupt_frame and self.frames > frames:
+            self._out[start + 20] ^= 0xFF
+
+
+def test_simulated_board_command_after_corrupt_frame():
+    board = SimulatedBoard(frame_len=256)
+    board.board = CorruptingEmulator(frame_len=256)
+    board.connect()
+    board.send_command("Send Data")
+    assert board.get_frames(8).shape[1] == 256
+
+    start = time.perf_counter()
+    board.send_command("Frame 512")
+    assert time.perf_counter() - start < 1
+    assert not board.acks
+    assert board.parser.crc_errors == 1
+
+    data = board.get_frames(16)
+    while data.shape[1] != 512:
+        data = board.get_frames(16)
+    assert board.sample_no == 512
+
+
+def test_pty_board_end_to_end():
+    bridge = PtyBridge(CorruptingEmulator(ToneSource((440,)), frame_len=256))
+    bridge.start()
+    try:
+        board = ArduinoBoard(bridge.port, 230400, timeout=2)
+        assert (board.sample_no, board.sample_freq) == (256, 4000)
+        board.send_command("Send Data")
+        board.get_frames(8)
+
+        start = time.perf_counter()
+        board.send_command("Sample 9k")
+        assert time.perf_counter() - start < 2
+        assert not board.acks
+
+        for _ in range(20):
+            board.get_frames(8)
+            if board.sample_freq == 9000:
+                break
+        assert board.sample_freq == 9000
+        assert board.parser.crc_errors == 1
+        board.board.close()
+    finally:
+        bridge.stop()
@@ -0,0 +1,27 @@
+import time
+import pytest
+from simulator import FirmwareEmulator, PtyBridge, ToneSource
+from supervisor import Supervisor
+
+
+def test_supervisor_with_pty_boards():
+    bridges = [PtyBridge(FirmwareEmulator(ToneSource((freq,)), frame_len=256, realtime=True))
+               for freq in (440, 880)]
+    for bridge in bridges:
+        bridge.start()
+    supervisor = Supervisor([dict(port=bridge.port, name="board{}".format(i))
+                             for i, bridge in enumerate(bridges)], interval=0.5)
+    supervisor.start()
+    try:
+        peaks = dict()
+        deadline = time.perf_counter() + 20
+        while len(peaks) < 2 and time.perf_counter() < deadline:
+            message = supervisor.poll()
+            if message is not None and message[0] == "result":
+                peaks[message[1]] = message[2]["peaks"][-1]
+        assert peaks["board0"] == pytest.approx(440, abs=5)
+        assert peaks["board1"] == pytest.approx(880, abs=5)
+    finally:
+        supervisor.stop()
+        for bridge in bridges:
+            bridge.stop()